@@ -1,7 +1,27 @@
 # This script is called as: python3 autocategorize.py path/to/sqlite-database.db FinancialAccountName
-# FinancialAccountName is one of valid_accounts from the verify_accounts() function below
+# FinancialAccountName is one of valid_accounts in moneydb.py. Or call it with --all-accounts instead of FinancialAccountName to categorize
+# every account's transactions in one run
 # To really understand how this autocategorizer works, read the reddit comment mentioned below. It shows how it works in <10 lines of code. It's very easy, I promise! :)
 # The rest of the code in this script is merely to feed data to and get data out of the autocategorizer
+# The trained classifier is cached on disk (see --model-cache), keyed by a fingerprint of the training data. As long as the
+# categorized transactions (or the training file) do not change, later runs load it instead of training it again
+# The classifier backend is pluggable (see --classifier). Features stay sparse from the vectorizer all the way into the classifier
+# The online backends (sgd, nb) also learn from every correction made at the prompt, without retraining from scratch
+# Before any of that, each uncategorized transaction is looked up in the account's merchant lookup index (table account+'Lookup'),
+# which maps a preprocessed description to the category it was most often given. Only descriptions not in there go to the classifier
+# Nothing reads a whole table at once: training data is read --chunk-size rows at a time (online backends are even trained chunk by
+# chunk), and uncategorized transactions are guessed, verified and written back one chunk at a time
+# With --batch, nobody has to sit through every row: guesses the classifier is at least --threshold sure of (and lookup index hits)
+# are written straight away, and only the rest are asked about at the prompt, least confident first
+# pandas, scikit-learn and prompt_toolkit are only imported by the functions that use them, and the classifier is trained (or loaded
+# from the cache) on a background thread. Until it is ready, transactions the lookup index does not know are guessed as the account's
+# most common category, and its guesses take over at the prompt as soon as it is done
+# With --all-accounts, every account's uncategorized transactions are categorized in one go, by one classifier trained on the
+# categorized transactions of all of the accounts. Merchants show up across cards and checking accounts, so each account's guesses
+# benefit from what was categorized in the others. The account is an extra word in each description (see model_inputs()), so the
+# classifier can still learn where an account differs. It is trained once, and guesses for all of the accounts in a single pass
+# With --metrics FILE, the time spent on the lookup index, reading training data, vectorizing, fitting, predicting, at the prompt and
+# writing back, and the db queries, are appended to FILE (see metrics.py)
 
 # https://stackabuse.com/text-classification-with-python-and-scikit-learn/
 # https://towardsdatascience.com/pandas-dataframe-playing-with-csv-files-944225d19ff?gi=8fce15d7d81d
@@ -25,31 +45,45 @@
 
 # pip install scikit-learn
 
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.preprocessing import LabelEncoder
-from sklearn.ensemble import RandomForestClassifier
+import time
+scriptStartTime = time.perf_counter() # For reporting how long it took until the first prompt
 
+# pandas, numpy, sklearn and prompt_toolkit together take over a second to import, so they are imported inside the functions that need them
 import re
 import argparse
-import sqlite3
-from prompt_toolkit import prompt
-from prompt_toolkit.completion import FuzzyWordCompleter
-from prompt_toolkit.validation import Validator, ValidationError
+import os
+import functools
+import itertools
+import hashlib
+import pickle
+import concurrent.futures
 
+import moneydb
+import metrics
+
+# Patterns used by preprocess_description(), compiled once. See the comments there for what each one does
+specialCharsPattern = re.compile(r'\W')
+wordsWithNumbersPattern = re.compile(r'\w*\d\w*')
+singleCharsPattern = re.compile(r"\b[a-zA-Z]\b")
+altSingleCharsPattern = re.compile(r'\s+[a-zA-Z]\s+')
+startSingleCharsPattern = re.compile(r'\^[a-zA-Z]\s+')
+multipleSpacesPattern = re.compile(r'\s+', flags=re.I)
+
+# Memoized, since the same merchant strings come up over and over again (training, lookup index, prediction)
+@functools.lru_cache(maxsize=1<<16)
 def preprocess_description(description):
 	# Remove all special characters
-	document = re.sub(r'\W', ' ', description)
+	document = specialCharsPattern.sub(' ', description)
 	# Remove all words containing numbers
-	document = re.sub(r'\w*\d\w*', '', document).strip()
+	document = wordsWithNumbersPattern.sub('', document).strip()
 	# Remove all single characters
-	document = re.sub(r"\b[a-zA-Z]\b", '', document)
+	document = singleCharsPattern.sub('', document)
 	# Alt. remove all single chars
-	document = re.sub(r'\s+[a-zA-Z]\s+', ' ', document)
+	document = altSingleCharsPattern.sub(' ', document)
 	# Remove all single chars from start
-	document = re.sub(r'\^[a-zA-Z]\s+', ' ', document)
+	document = startSingleCharsPattern.sub(' ', document)
 	# Substitute multiple spaces with single space
-	document = re.sub(r'\s+', ' ', document, flags=re.I)
+	document = multipleSpacesPattern.sub(' ', document)
 	# Convert string to lower case
 	document = document.lower()
 	# Remove "aplpay" and "com" (for .com) from string
@@ -57,59 +91,294 @@ def preprocess_description(description):
 	document = document.replace('com', '')
 	return document
 
-def fetch_training_data(dbconn, account, trainingfile):
-	df = pd.DataFrame() # This will hold the Description,Categories that will train the classifier
+def preprocess_descriptions(descriptions):
+	# Batch version of preprocess_description() for a whole column (list, numpy array or pandas Series) of descriptions. Returns a list
+	# Each distinct description is processed once (and only if it is not memoized already), then mapped back onto the column
+	# NOTE: Running the same steps column-wise with pandas' .str.replace() was measured to be slower than this. It loops over the
+	# strings in Python as well, once per step. See benchmark-preprocess.py
+	processed = {description: preprocess_description(description) for description in set(descriptions)}
+	return [processed[description] for description in descriptions]
+
+def account_word(account):
+	# The word model_inputs() adds for account. One word, and no digits, so the vectorizers keep it as a feature
+	return 'acct_'+account.lower()
+
+def model_inputs(descriptions, accounts=None):
+	# What the vectorizer gets for each (unprocessed payee + memo) description: the preprocessed description, followed by a word
+	# for its account if accounts is given (for the classifier shared by all accounts, see --all-accounts)
+	# The account word is added after preprocessing, so none of the steps in preprocess_description() can mangle it
+	processed = preprocess_descriptions(descriptions)
+	if accounts is None:
+		return processed
+	return [description+' '+account_word(account) for (description, account) in zip(processed, accounts)]
+
+def transaction_inputs(transactions, accounts=None):
+	# model_inputs() of TransactionId,Payee,Memo,Amount rows. For the classifier shared by all accounts, accounts is the account of each row
+	if accounts is not None and len(accounts) != len(transactions):
+		raise ValueError(f'{len(transactions)} transactions but {len(accounts)} accounts')
+	return model_inputs([row[1]+' '+row[2] for row in transactions], accounts)
+
+def get_training_chunks(dbconn, account, trainingfile, chunksize=10000):
+	# Returns a function that, each time it is called, gives a fresh iterator of DataFrames of at most chunksize rows with
+	# Description and Category columns. That way the training data can be read more than once (fingerprint, training epochs)
+	# without ever being held in memory as a whole
+	import pandas as pd
 	dbcursor = dbconn.cursor()
 	if trainingfile: # i.e. if trainingfile is not None, use that as source of training data
 		# This is a csv file with Description and Category columns
 		print (f'Using training file {trainingfile} for training.')
-		df = pd.read_csv(trainingfile) # TODO: Error checking
-		
-		df['Description'] = df.Description
-		df['Category'] = df.Category
-		if len(df) < 1:
+		if len(pd.read_csv(trainingfile, nrows=1)) < 1: # TODO: Error checking
 			print(f'Trainingfile seems to be empty. Stopping..')
 			quit()
+		def read_chunks():
+			for df in pd.read_csv(trainingfile, chunksize=chunksize):
+				yield df[['Description', 'Category']]
 	elif trainingfile == None: # Load pre-categorized transactions in db as training data
 		institution = account+'Trans' # See sqlite db structure. Basically db column names are either account+'Trans' for transactions or account+'Meta' for metadata
-		dbcursor.execute('''SELECT Payee,Memo,Category FROM '''+institution+''' WHERE Category != 'Unknown' ''')
-		raw_training_records = dbcursor.fetchall() # FIXME: Can blow up with memory issues if there are too many records
-		if len(raw_training_records) < 1:
+		dbcursor.execute('''SELECT COUNT(*) FROM '''+institution+''' WHERE Category != 'Unknown' ''')
+		nTrainingTransactions = dbcursor.fetchone()[0]
+		if nTrainingTransactions < 1:
 			print ("Hmm... seems like there are no categorized records available for training. Quitting.")
 			quit()
-		nTrainingTransactions = len(raw_training_records)
 		print (f"Using {nTrainingTransactions} previously categorized transactions for training.")
-		training_description = []
-		training_categories = []
-		for row in raw_training_records:
-			training_description.append(row[0]+' '+row[1]) # training description is combination of payee and memo
-			training_categories.append(row[2])
-		df['Description'] = training_description
-		df['Category'] = training_categories
-		
-	return df
+		def read_chunks():
+			chunkcursor = dbconn.cursor()
+			chunkcursor.execute('''SELECT Payee,Memo,Category FROM '''+institution+''' WHERE Category != 'Unknown' ''')
+			while True:
+				rows = chunkcursor.fetchmany(chunksize)
+				if not rows:
+					break
+				# training description is combination of payee and memo
+				yield pd.DataFrame({'Description': [row[0]+' '+row[1] for row in rows], 'Category': [row[2] for row in rows]})
+	return read_chunks
+
+def get_training_categories(dbconn, account, trainingfile, chunksize=10000):
+	# The distinct categories in the training data, without reading the whole of it into memory
+	if trainingfile:
+		import pandas as pd
+		categories = set()
+		for df in pd.read_csv(trainingfile, usecols=['Category'], chunksize=chunksize):
+			categories.update(df['Category'])
+		return sorted(categories)
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT DISTINCT Category FROM '''+account+'''Trans WHERE Category != 'Unknown' ''')
+	return [row[0] for row in dbcursor]
+
+def fetch_training_data(dbconn, account, trainingfile):
+	# All of the training data in one DataFrame with Description and Category columns. See get_training_chunks()
+	import pandas as pd
+	chunks = list(get_training_chunks(dbconn, account, trainingfile)())
+	if len(chunks) < 1:
+		return pd.DataFrame({'Description': [], 'Category': []})
+	return pd.concat(chunks, ignore_index=True)
+
+def get_all_accounts_training_chunks(dbconn, accounts, chunksize=10000):
+	# Like get_training_chunks(), but for the categorized transactions of all of accounts, with an Account column as well
+	import pandas as pd
+	dbcursor = dbconn.cursor()
+	union = ''' UNION ALL '''.join(moneydb.account_sql('''SELECT Payee,Memo,Category,'{Account}' FROM {Trans} WHERE Category != 'Unknown' ''', account) for account in accounts)
+	nTrainingTransactions = dbcursor.execute('''SELECT COUNT(*) FROM ('''+union+''')''').fetchone()[0]
+	if nTrainingTransactions < 1:
+		print ("Hmm... seems like there are no categorized records available for training. Quitting.")
+		quit()
+	print (f"Using {nTrainingTransactions} previously categorized transactions of {len(accounts)} accounts for training.")
+	def read_chunks():
+		chunkcursor = dbconn.cursor()
+		chunkcursor.execute(union)
+		while True:
+			rows = chunkcursor.fetchmany(chunksize)
+			if not rows:
+				break
+			yield pd.DataFrame({'Description': [row[0]+' '+row[1] for row in rows], 'Category': [row[2] for row in rows], 'Account': [row[3] for row in rows]})
+	return read_chunks
+
+# Classifier backends. Each one makes a (vectorizer, classifier) pair. The vectorizer turns preprocessed descriptions into a sparse
+# matrix and the classifier is fit directly on that sparse matrix. Backends whose classifier has partial_fit are online: they can be
+# updated with a few more labelled descriptions at a time (see update_classifier()). Their vectorizer is a HashingVectorizer, which
+# needs no fitting, so words that first show up in a correction still count
+def make_forest_backend():
+	from sklearn.feature_extraction.text import TfidfVectorizer
+	from sklearn.ensemble import RandomForestClassifier
+	return (TfidfVectorizer(), RandomForestClassifier(n_jobs=-1, n_estimators=100))
+
+def make_sgd_backend():
+	# log_loss makes it a logistic regression, which also gives class probabilities
+	from sklearn.feature_extraction.text import HashingVectorizer
+	from sklearn.linear_model import SGDClassifier
+	return (HashingVectorizer(n_features=2**20, alternate_sign=False), SGDClassifier(loss='log_loss', alpha=1e-5))
 
-def get_trained_classifier(df):
+def make_nb_backend():
+	# alternate_sign=False keeps the features non-negative, which MultinomialNB requires
+	from sklearn.feature_extraction.text import HashingVectorizer
+	from sklearn.naive_bayes import MultinomialNB
+	return (HashingVectorizer(n_features=2**20, alternate_sign=False), MultinomialNB(alpha=0.01))
+
+classifier_backends = {'forest': make_forest_backend, 'sgd': make_sgd_backend, 'nb': make_nb_backend}
+
+def is_online_backend(backend):
+	return hasattr(classifier_backends[backend]()[1], 'partial_fit')
+
+def get_trained_classifier(df, backend='forest', categories=None, epochs=5):
 	# TODO: Check that df is not NULL etc. df['Description'] should have training descriptions. df['Category'] should have corresponding categories for training
-	# First, we need to pre-process the descriptions. See documentation comments of preprocess_description() for more
-	df['ProcessedDescription'] = [preprocess_description(x) for x in df.Description] # Hmm.. seems like df['Description'] and df.Description are equivalent??
-	tfidf=TfidfVectorizer()
-	x_train = tfidf.fit_transform(df['ProcessedDescription'])
+	# Returns (classifier, tfidf, le). tfidf is whatever vectorizer the backend uses, not necessarily a TfidfVectorizer
+	# categories are the valid categories (see get_valid_categories()). Online backends have to know all classes up front to be
+	# updated later, so le is fit on those as well as on the categories in df
+	return get_trained_classifier_from_chunks(lambda: iter([df]), backend, sorted(set(df['Category']) | set(categories or [])), epochs)
+
+def get_trained_classifier_from_chunks(read_chunks, backend='forest', categories=None, epochs=5):
+	# Like get_trained_classifier(), but the training data comes from read_chunks (see get_training_chunks())
+	# Online backends are trained chunk by chunk with partial_fit, so only one chunk is in memory at a time. For them, categories
+	# must include every category in the training data (see get_training_categories())
+	# The forest backend needs all of the data at once to fit the TfidfVectorizer and the forest, so its chunks are put back together
+	import numpy as np
+	import pandas as pd
+	from sklearn.preprocessing import LabelEncoder
+	from sklearn.linear_model import SGDClassifier
+	(tfidf, classifier) = classifier_backends[backend]()
 	le = LabelEncoder()
-	y_train = le.fit_transform(df['Category'])
-	classifier = RandomForestClassifier(n_jobs=-1, n_estimators=100)
-	classifier.fit(x_train.todense(), y_train)
+	if hasattr(classifier, 'partial_fit'):
+		le.fit(categories)
+		classes = np.arange(len(le.classes_))
+		# A few shuffled passes, since a single partial_fit pass of SGD is a lot weaker than a full fit
+		rng = np.random.default_rng(0)
+		for epoch in range(epochs if isinstance(classifier, SGDClassifier) else 1):
+			for df in read_chunks():
+				metrics.count('rowsTrained', len(df))
+				with metrics.stage('vectorize'):
+					# First, we need to pre-process the descriptions. See documentation comments of preprocess_description() for more
+					x_train = tfidf.transform(model_inputs(df['Description'], df['Account'] if 'Account' in df else None))
+					y_train = le.transform(df['Category'])
+				with metrics.stage('fit'):
+					order = rng.permutation(len(y_train))
+					classifier.partial_fit(x_train[order], y_train[order], classes=classes)
+	else:
+		with metrics.stage('training-data'):
+			df = pd.concat(list(read_chunks()), ignore_index=True)
+		metrics.count('rowsTrained', len(df))
+		with metrics.stage('vectorize'):
+			# First, we need to pre-process the descriptions. See documentation comments of preprocess_description() for more
+			x_train = tfidf.fit_transform(model_inputs(df['Description'], df['Account'] if 'Account' in df else None))
+			y_train = le.fit_transform(df['Category'])
+		with metrics.stage('fit'):
+			classifier.fit(x_train, y_train)
 	
 	return(classifier, tfidf, le)
+
+def update_classifier(model, descriptions, categories, accounts=None):
+	# Online update of model = (classifier, tfidf, le) with a few more labelled descriptions (unprocessed payee + memo)
+	# accounts are the accounts of the descriptions if model is shared by all accounts, see model_inputs()
+	# Returns True if the model was updated. Backends without partial_fit (forest) are left as they are
+	(classifier, tfidf, le) = model
+	if not hasattr(classifier, 'partial_fit'):
+		return False
+	inputs = model_inputs(descriptions, accounts)
+	known = [(description, category) for (description, category) in zip(inputs, categories) if category in le.classes_]
+	if len(known) < 1:
+		return False
+	x_update = tfidf.transform([description for (description, category) in known])
+	y_update = le.transform([category for (description, category) in known])
+	classifier.partial_fit(x_update, y_update)
+	return True
+
+def get_training_fingerprint(chunks, source, backend='forest', categories=None):
+	# Identifies a set of training data: where it came from (account or training file), how many rows and a hash of their content
+	# chunks is an iterable of DataFrames with Description and Category columns, e.g. [df]
+	# The backend is part of the name, so each backend has its own cache entries. The valid categories are hashed too, since online backends are fit on them
+	# The sklearn version is part of the hash since pickled models are not guaranteed to load across sklearn versions
+	import sklearn
+	sha = hashlib.sha256(sklearn.__version__.encode())
+	for category in sorted(categories or []):
+		sha.update(f'{category}\n'.encode())
+	nRows = 0
+	for df in chunks:
+		if 'Account' in df: # Training data of all accounts, see get_all_accounts_training_chunks()
+			for (description, category, account) in zip(df['Description'], df['Category'], df['Account']):
+				sha.update(f'{description}\0{category}\0{account}\n'.encode())
+		else:
+			for (description, category) in zip(df['Description'], df['Category']):
+				sha.update(f'{description}\0{category}\n'.encode())
+		nRows = nRows + len(df)
+	sourceName = re.sub(r'\W', '_', source)
+	return f'{sourceName}_{backend}-{nRows}-{sha.hexdigest()[:16]}'
+
+def load_cached_classifier(modelcachedir, fingerprint):
+	# Returns the cached (classifier, tfidf, le) for fingerprint, or None if there is none
+	cachefilename = os.path.join(modelcachedir, fingerprint+'.pickle')
+	if not os.path.exists(cachefilename):
+		return None
+	try:
+		with open(cachefilename, 'rb') as cachefile:
+			model = pickle.load(cachefile)
+	except Exception as e:
+		print(f'Could not load cached classifier {cachefilename} ({e}). Retraining..')
+		os.remove(cachefilename)
+		return None
+	os.utime(cachefilename) # Mark it as recently used, see evict_cached_classifiers()
+	return model
+
+def save_cached_classifier(modelcachedir, fingerprint, model):
+	os.makedirs(modelcachedir, exist_ok=True)
+	cachefilename = os.path.join(modelcachedir, fingerprint+'.pickle')
+	# Write to a temporary file first so a crash never leaves a half-written cache entry behind
+	with open(cachefilename+'.tmp', 'wb') as cachefile:
+		pickle.dump(model, cachefile, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(cachefilename+'.tmp', cachefilename)
+
+def evict_cached_classifiers(modelcachedir, fingerprint, keep):
+	# Every time the training data changes a new cache entry is made, so only the keep most recently used entries of the same source are kept
+	sourceName = fingerprint.rsplit('-', 2)[0]
+	entries = []
+	for name in os.listdir(modelcachedir):
+		if name.endswith('.pickle') and name.rsplit('-', 2)[0] == sourceName:
+			entries.append(os.path.join(modelcachedir, name))
+	entries.sort(key=os.path.getmtime, reverse=True)
+	for stale in entries[keep:]:
+		os.remove(stale)
+
+def get_classifier(read_chunks, source, modelcachedir, rebuildmodel, modelcachekeep, backend='forest', categories=None):
+	# Same as get_trained_classifier_from_chunks(), but goes through the on-disk cache. modelcachedir None turns the cache off
+	if modelcachedir is None:
+		return get_trained_classifier_from_chunks(read_chunks, backend, categories)
+	with metrics.stage('fingerprint'):
+		fingerprint = get_training_fingerprint(read_chunks(), source, backend, categories)
+	if not rebuildmodel:
+		with metrics.stage('cache-load'):
+			model = load_cached_classifier(modelcachedir, fingerprint)
+		if model is not None:
+			print(f'Using cached classifier {fingerprint}.')
+			return model
+	model = get_trained_classifier_from_chunks(read_chunks, backend, categories)
+	save_cached_classifier(modelcachedir, fingerprint, model)
+	evict_cached_classifiers(modelcachedir, fingerprint, modelcachekeep)
+	print(f'Trained classifier saved to cache as {fingerprint}.')
+	return model
 	
+def iter_uncategorized_transactions(dbconn, account, chunksize=1000):
+	# Generator of lists of at most chunksize TransactionId,Payee,Memo,Amount rows of uncategorized transactions
+	# Pages through them by TransactionId (the primary key) instead of keeping one cursor open, since each chunk is usually
+	# written back before the next one is read, and rows should not change under an open cursor
+	lastTransactionId = ''
+	while True:
+		dbcursor = dbconn.cursor()
+		dbcursor.execute(moneydb.account_sql('''SELECT TransactionId,Payee, Memo, Amount FROM {Trans} WHERE Category = 'Unknown' AND TransactionId > ? ORDER BY TransactionId LIMIT ?''', account), (lastTransactionId, chunksize))
+		uncategorized_records = dbcursor.fetchall()
+		if len(uncategorized_records) < 1:
+			return
+		yield uncategorized_records
+		lastTransactionId = uncategorized_records[-1][0]
+
 def get_uncategorized_transactions(dbconn, account):
-	dbcursor = dbconn.cursor()
-	institution = account+'Trans'
-	dbcursor.execute('''SELECT TransactionId,Payee, Memo, Amount FROM '''+institution+''' WHERE Category = 'Unknown' ''')
-	uncategorized_records = dbcursor.fetchall() # FIXME: Can blow up with memory issues if there are too many records
-	return uncategorized_records
+	return list(itertools.chain.from_iterable(iter_uncategorized_transactions(dbconn, account)))
 
 def categorize_transactions(classifier, tfidf, le, uncategorized_transactions):
+	(guessed_categories, confidences) = categorize_transactions_with_confidence(classifier, tfidf, le, uncategorized_transactions)
+	return guessed_categories
+
+def categorize_transactions_with_confidence(classifier, tfidf, le, uncategorized_transactions, accounts=None):
+	# Returns (guessed_categories, confidences). The confidence of a guess is the probability the classifier gives its category
+	# accounts is the account of each row if the classifier is the one shared by all accounts, see transaction_inputs()
+	# Every backend's classifier has predict_proba, and picking the most probable class is what predict() does anyway
+	import numpy as np
 	uncategorized_transids = []
 	uncategorized_descs = []
 	#uncategorized_amounts = []
@@ -119,11 +388,131 @@ def categorize_transactions(classifier, tfidf, le, uncategorized_transactions):
 		uncategorized_descs.append(row[1]+' '+row[2]) # descs == payee + memo
 		#uncategorized_amounts.append(row[3]) # Not sure this is actually needed in this function
 
-	descs_to_categorize = [preprocess_description(x) for x in uncategorized_descs]
-	x_predict = tfidf.transform(descs_to_categorize)
-	predicted = classifier.predict(x_predict.todense())
-	guessed_categories = le.inverse_transform(predicted)
-	return guessed_categories
+	metrics.count('rowsPredicted', len(uncategorized_descs))
+	with metrics.stage('predict'):
+		descs_to_categorize = transaction_inputs(uncategorized_transactions, accounts)
+		x_predict = tfidf.transform(descs_to_categorize)
+		probabilities = classifier.predict_proba(x_predict)
+	best = probabilities.argmax(axis=1)
+	predicted = classifier.classes_[best]
+	guessed_categories = [str(category) for category in le.inverse_transform(predicted)]
+	confidences = [float(confidence) for confidence in probabilities[np.arange(len(best)), best]]
+	return (guessed_categories, confidences)
+
+# The merchant lookup index. account+'Lookup' has one row per (preprocessed description, category) with the number of categorized
+# transactions in account+'Trans' that have them. The category with the highest count is what a description resolves to
+def ensure_lookup_index(dbconn, account, rebuild=False):
+	# Creates account+'Lookup' if needed. It is (re)built from account+'Trans' if rebuild is set or if it no longer adds up to the
+	# number of categorized transactions, e.g. because categories were edited by hand in sqlitestudio
+	# Changing a transaction that was categorized already (say from Groceries to Dining) leaves that number as it was, so the
+	# triggers from ensure_lookup_triggers() empty the index when that happens, which makes it get rebuilt here
+	dbcursor = dbconn.cursor()
+	institution = account+'Trans'
+	institutionLookup = account+'Lookup'
+	dbcursor.execute('''CREATE TABLE IF NOT EXISTS '''+institutionLookup+''' ("Description" TEXT NOT NULL, "Category" TEXT NOT NULL, "Count" INTEGER NOT NULL, PRIMARY KEY ("Description", "Category"))''')
+	if ensure_lookup_triggers(dbconn, account):
+		rebuild = True # Whatever happened before the triggers were there went unnoticed
+	nIndexed = dbcursor.execute('''SELECT COALESCE(SUM(Count), 0) FROM '''+institutionLookup).fetchone()[0]
+	nCategorized = dbcursor.execute('''SELECT COUNT(*) FROM '''+institution+''' WHERE Category != 'Unknown' ''').fetchone()[0]
+	if nIndexed == nCategorized and not rebuild:
+		return
+	print(f'Building merchant lookup index from {nCategorized} categorized transactions.')
+	counts = {}
+	dbcursor.execute('''SELECT Payee,Memo,Category FROM '''+institution+''' WHERE Category != 'Unknown' ''')
+	for row in dbcursor:
+		key = (preprocess_description(row[0]+' '+row[1]), row[2])
+		counts[key] = counts.get(key, 0) + 1
+	with moneydb.write_transaction(dbconn):
+		dbcursor.execute('''DELETE FROM '''+institutionLookup)
+		dbcursor.executemany('''INSERT INTO '''+institutionLookup+'''("Description", "Category", "Count") VALUES (?,?,?)''', [key + (count,) for (key, count) in counts.items()])
+
+def ensure_lookup_triggers(dbconn, account):
+	# Creates the triggers that empty account+'Lookup' when the Payee, Memo or Category of an already categorized transaction is
+	# changed, or it is deleted, unless they are there already. Returns True if they had to be created
+	# In the unified layout (see moneydb.py) they are on Transactions, for account's rows. migrate-to-unified.py drops the ones on
+	# account+'Trans', so they are created again, and the index rebuilt, the next time it is used
+	institutionLookup = account+'Lookup'
+	if dbconn.execute('''SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?''', (institutionLookup+'StaleUpdate',)).fetchone() is not None:
+		return False
+	if moneydb.is_unified(dbconn):
+		(table, accountColumn, accountCondition) = ('Transactions', ''', "Account"''', '''OLD."Account" = \''''+account+'''\' AND ''')
+	else:
+		(table, accountColumn, accountCondition) = (account+'Trans', '', '')
+	with moneydb.write_transaction(dbconn):
+		dbconn.execute('''CREATE TRIGGER IF NOT EXISTS '''+institutionLookup+'''StaleUpdate AFTER UPDATE OF "Payee", "Memo", "Category"'''+accountColumn+''' ON '''+table+'''
+			WHEN '''+accountCondition+'''OLD."Category" != 'Unknown' AND (OLD."Payee" IS NOT NEW."Payee" OR OLD."Memo" IS NOT NEW."Memo" OR OLD."Category" IS NOT NEW."Category"'''+(''' OR OLD."Account" IS NOT NEW."Account"''' if accountColumn else '')+''')
+			BEGIN DELETE FROM '''+institutionLookup+'''; END''')
+		dbconn.execute('''CREATE TRIGGER IF NOT EXISTS '''+institutionLookup+'''StaleDelete AFTER DELETE ON '''+table+'''
+			WHEN '''+accountCondition+'''OLD."Category" != 'Unknown'
+			BEGIN DELETE FROM '''+institutionLookup+'''; END''')
+	return True
+
+def load_lookup_index(dbconn, account):
+	# Returns a dict of preprocessed description -> its most common category. Ties go to the alphabetically first category
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT Description,Category FROM '''+account+'''Lookup ORDER BY Description, Count, Category DESC''')
+	lookup = {}
+	for (description, category) in dbcursor:
+		lookup[description] = category # The last row of each description wins, which is the one with the highest count
+	return lookup
+
+def update_lookup_index(dbconn, account, uncategorized_transactions, verified_categories):
+	# Adds newly categorized transactions to account+'Lookup'. Does not commit, so it goes in the same transaction as the category UPDATEs
+	descriptions = preprocess_descriptions([row[1]+' '+row[2] for row in uncategorized_transactions]) # row is TransactionId,Payee,Memo,Amount
+	rows = [(description, category) for (description, category) in zip(descriptions, verified_categories) if category != 'Unknown']
+	dbconn.executemany(moneydb.account_sql('''INSERT INTO {Lookup}("Description", "Category", "Count") VALUES (?,?,1) ON CONFLICT("Description", "Category") DO UPDATE SET "Count" = "Count" + 1''', account), rows)
+
+def ready_classifier(model):
+	# model is (classifier, tfidf, le), None, or a Future that gives (classifier, tfidf, le) once it is trained (see train_classifier())
+	# Returns the model if it can be used right now, else None. Does not wait. If the training failed, that is None too
+	if isinstance(model, concurrent.futures.Future):
+		return model.result() if model.done() and model.exception() is None else None
+	return model
+
+def wait_for_classifier(model):
+	# Like ready_classifier(), but waits for a model that is still being trained
+	# If the training failed, says so and returns None instead of raising, so a review session in progress is not lost. Guesses are
+	# then only from the lookup index, and the fallback category for the rest. train_classifier() can even quit(), which is a SystemExit
+	if isinstance(model, concurrent.futures.Future):
+		if not model.done():
+			print('Waiting for the classifier to finish training..')
+		with metrics.stage('wait-for-classifier'):
+			e = model.exception()
+		if e is not None:
+			print(f'Could not train the classifier ({e!r}). Guessing from the merchant lookup index only.')
+			return None
+		return model.result()
+	return model
+
+def has_training_data(dbconn, account, trainingfile):
+	# False if train_classifier() would have nothing to train on. A training file is only checked for when it is read
+	if trainingfile:
+		return True
+	return dbconn.execute(moneydb.account_sql('''SELECT EXISTS (SELECT 1 FROM {Trans} WHERE Category != 'Unknown')''', account)).fetchone()[0] == 1
+
+def guess_categories(model, lookup, uncategorized_transactions, fallback='Unknown', accounts=None):
+	# Guesses from the lookup index where there is an exact match, and from model = (classifier, tfidf, le) for the rest
+	# Returns (guessed_categories, confidences, number of lookup hits). With model None (or not trained yet), misses are guessed as fallback
+	# A lookup hit is a merchant that has been categorized before, so its confidence is 1. A fallback guess has confidence 0
+	model = ready_classifier(model)
+	guessed_categories = [lookup.get(description) for description in transaction_inputs(uncategorized_transactions, accounts)]
+	confidences = [1.0] * len(guessed_categories)
+	misses = [i for i in range(len(guessed_categories)) if guessed_categories[i] is None]
+	if len(misses) > 0 and model is not None:
+		(predicted, predictedConfidences) = categorize_transactions_with_confidence(*model, [uncategorized_transactions[i] for i in misses], None if accounts is None else [accounts[i] for i in misses])
+	else:
+		(predicted, predictedConfidences) = ([fallback] * len(misses), [0.0] * len(misses))
+	for (i, category, confidence) in zip(misses, predicted, predictedConfidences):
+		guessed_categories[i] = category
+		confidences[i] = confidence
+	return (guessed_categories, confidences, len(guessed_categories) - len(misses))
+
+def get_fallback_category(dbconn, account):
+	# The cheap guess for transactions the lookup index does not know while the classifier is not ready: the account's most common category
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT Category FROM '''+account+'''Trans WHERE Category != 'Unknown' GROUP BY Category ORDER BY COUNT(*) DESC, Category LIMIT 1''')
+	row = dbcursor.fetchone()
+	return 'Unknown' if row is None else row[0]
 
 def get_valid_categories(dbconn):
 	dbcursor = dbconn.cursor()
@@ -136,9 +525,19 @@ def get_valid_categories(dbconn):
 	return valid_categories
 
 # An interactive function
-def verify_categories_and_add_notes(dbconn, uncategorized_transactions, guessed_categories):
+# Every correction is remembered in lookup (if given) for the rest of the session, and if model (classifier, tfidf, le) is given
+# and its backend is online, the correction updates it too. Either way the remaining guesses are then redone
+# model may also still be training in the background (see train_classifier()). Until it is done, the guesses it did not make are
+# fallback guesses (see guess_categories()), and once it is, the rows not yet gone through are guessed again with it
+# If confidences are given, each prompt shows how confident the guess is
+# Returns (true_categories, notes, nVerified). nVerified is the number of rows the user went through, less than all of them if they typed q
+def verify_categories_and_add_notes(dbconn, uncategorized_transactions, guessed_categories, model=None, lookup=None, confidences=None, fallback='Unknown', accounts=None):
+	from prompt_toolkit import prompt
+	from prompt_toolkit.completion import FuzzyWordCompleter
+	from prompt_toolkit.validation import Validator
+	from prompt_toolkit.patch_stdout import patch_stdout
 	valid_categories = get_valid_categories(dbconn)
-	true_categories = guessed_categories
+	true_categories = list(guessed_categories) # A list, since a numpy array of strings would truncate categories longer than the longest guess
 	category_completer = FuzzyWordCompleter(valid_categories)
 	
 	def is_valid_category(text):
@@ -157,21 +556,48 @@ def verify_categories_and_add_notes(dbconn, uncategorized_transactions, guessed_
 		move_cursor_to_end=True)
 
 	notes = [''] * len(guessed_categories) # Place holder list for any notes that may need to be added
+	nVerified = len(guessed_categories)
+	modelPending = ready_classifier(model) is None and model is not None
 	for i in range(len(guessed_categories)):
+		if modelPending and ready_classifier(model) is not None:
+			modelPending = False
+			(guessed_categories[i:], newConfidences, nHits) = guess_categories(model, lookup or {}, uncategorized_transactions[i:], fallback, None if accounts is None else accounts[i:])
+			true_categories[i:] = guessed_categories[i:]
+			if confidences is not None:
+				confidences[i:] = newConfidences
+			print(f'Classifier ready after {time.perf_counter()-scriptStartTime:.1f}s. The rest of the guesses are its own.')
 		# Need to prompt user whether the category was correct. If not, user should enter the correct category
 		# user entered category must be validated to be in the master Category list, else polite error msg
 		# user entered category must overwrite guessed category
 		
-		true_category = prompt(f'{uncategorized_transactions[i]} --> {guessed_categories[i]} . [Enter] to accept, q to quit, or type correct category:', completer=category_completer, validator=CategoryValidator)
+		confidence = '' if confidences is None else f' ({100*confidences[i]:.0f}% sure)'
+		with patch_stdout(): # Anything the background training prints goes above the prompt instead of through it
+			true_category = prompt(f'{uncategorized_transactions[i]} --> {guessed_categories[i]}{confidence} . [Enter] to accept, q to quit, or type correct category:', completer=category_completer, validator=CategoryValidator)
 		if true_category == 'q':
+			nVerified = i
 			break
 		elif true_category:
 			true_categories[i] = true_category
 			#print(f'True category is {true_category}')
-		note = prompt(f'Add note? :')
+			if true_category != guessed_categories[i]:
+				# The correction is learned (by the classifier and the session's lookup) even for the last row of the chunk, the next
+				# chunk is guessed with it
+				row = uncategorized_transactions[i] # TransactionId,Payee,Memo,Amount
+				rowAccounts = None if accounts is None else [accounts[i]]
+				modelUpdated = ready_classifier(model) is not None and update_classifier(ready_classifier(model), [row[1]+' '+row[2]], [true_category], rowAccounts)
+				if lookup is not None:
+					lookup[transaction_inputs([row], rowAccounts)[0]] = true_category
+				# Only the rows after this one in the chunk are left to guess again
+				if (modelUpdated or lookup is not None) and i+1 < len(guessed_categories):
+					(guessed_categories[i+1:], newConfidences, nHits) = guess_categories(model, lookup or {}, uncategorized_transactions[i+1:], fallback, None if accounts is None else accounts[i+1:])
+					true_categories[i+1:] = guessed_categories[i+1:]
+					if confidences is not None:
+						confidences[i+1:] = newConfidences
+		with patch_stdout():
+			note = prompt(f'Add note? :')
 		if note:
 			notes[i] = note
-	return (true_categories, notes)
+	return (true_categories, notes, nVerified)
 
 def write_verified_categories_to_db(dbconn, account, uncategorized_transactions, verified_categories, notes):
 	dbcursor = dbconn.cursor()
@@ -183,62 +609,237 @@ def write_verified_categories_to_db(dbconn, account, uncategorized_transactions,
 		print (f'Something is VERY WRONG: Length of notes != Length of verified_categories. ABORTING!')
 		quit()
 	
-	institution = account+'Trans'
-	for i in range(len(verified_categories)):
-		# uncategorized_transactions[i] should be the i'th row and each row is TransactionId,Payee,Memo,Amount
-		dbcursor.execute('''UPDATE '''+institution+''' SET Category = ?, Notes = ? WHERE "TransactionId" = ?''', (verified_categories[i], notes[i], uncategorized_transactions[i][0]))
+	# uncategorized_transactions[i] should be the i'th row and each row is TransactionId,Payee,Memo,Amount
+	# One executemany for all rows, and one write transaction for it and the lookup index update
+	metrics.count('rowsWritten', len(verified_categories))
+	with metrics.stage('write'), moneydb.write_transaction(dbconn):
+		dbcursor.executemany(moneydb.account_sql('''UPDATE {Trans} SET Category = ?, Notes = ? WHERE "TransactionId" = ?''', account), zip(verified_categories, notes, [row[0] for row in uncategorized_transactions]))
+		update_lookup_index(dbconn, account, uncategorized_transactions, verified_categories)
 
-	dbconn.commit()
+def write_verified_categories_by_account(dbconn, accounts, uncategorized_transactions, verified_categories, notes):
+	# write_verified_categories_to_db() for rows of any of the accounts, all in one write transaction. accounts is the account of each row
+	rowsByAccount = {}
+	for (account, row, category, note) in zip(accounts, uncategorized_transactions, verified_categories, notes):
+		rowsByAccount.setdefault(account, []).append((row, category, note))
+	with moneydb.write_transaction(dbconn):
+		for (account, rows) in rowsByAccount.items():
+			write_verified_categories_to_db(dbconn, account, [row for (row, category, note) in rows], [category for (row, category, note) in rows], [note for (row, category, note) in rows])
 
-def auto_categorize(dbconn, account, trainingfilename):
+def train_classifier(sqlitedbfilename, account, trainingfilename, modelcachedir, rebuildmodel, modelcachekeep, backend):
+	# Reads the training data and trains the classifier on it, or loads it from the cache. Returns (classifier, tfidf, le)
+	# Meant to be run on a background thread (see auto_categorize()), so it uses its own connection to the db. sqlite connections
+	# can only be used from the thread that opened them
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	try:
+		with metrics.stage('train'): # All of it, including reading the training data or loading the classifier from the cache
+			categories = get_valid_categories(dbconn)
+			if is_online_backend(backend):
+				categories = sorted(set(categories) | set(get_training_categories(dbconn, account, trainingfilename)))
+			read_chunks = get_training_chunks(dbconn, account, trainingfilename) # Remember: The training descriptions returned are not pre-processed for training
+			source = account if trainingfilename is None else os.path.basename(trainingfilename)
+			return get_classifier(read_chunks, source, modelcachedir, rebuildmodel, modelcachekeep, backend, categories)
+	finally:
+		dbconn.close()
+
+def auto_categorize(dbconn, account, trainingfilename, modelcachedir, rebuildmodel, modelcachekeep, backend, rebuildlookup, chunksize, batch=False, threshold=0.9):
+	# Load up the Uncategorized transactions in account, chunksize at a time, and look them up in the merchant lookup index
 	# Decide whether to use training file or pre-categorized transactions
-	# Load up the training data and train the classifier
-	# Load up the Uncategorized transactions in account and categorize them
-	# Do interactive check of categorization along with additional Notes
+	# Load up the training data and train the classifier, but only once there are transactions the lookup index could not resolve
+	# Training happens on a background thread, so the prompts can start right away with fallback guesses (see get_fallback_category())
+	# Categorize those with the classifier
+	# Do interactive check of categorization along with additional Notes, and write the chunk back before moving on to the next one
+	# Once the user quits, the remaining chunks are written with their guessed categories, same as the rest of the chunk they quit in
+	# In batch mode, guesses with confidence >= threshold are written without asking, chunk by chunk. The rest are queued, and only
+	# asked about once every chunk has been guessed, least confident first. Queued rows the user did not get to before quitting stay Unknown
 	
-	df = fetch_training_data(dbconn, account, trainingfilename) # Remember: The training descriptions returned are not pre-processed for training
-	# TODO: Ensure that df is not NULL etc.
-	(classifier, tfidf, le) = get_trained_classifier(df)
-	uncategorized_transactions = get_uncategorized_transactions(dbconn, account) # Will return TransactionId,Payee,Memo,Amount of uncategorized transactions
-	if len(uncategorized_transactions) < 1:
+	with metrics.stage('lookup'):
+		ensure_lookup_index(dbconn, account, rebuildlookup)
+		lookup = load_lookup_index(dbconn, account)
+	fallback = get_fallback_category(dbconn, account)
+	sqlitedbfilename = dbconn.execute('PRAGMA database_list').fetchone()[2] # The file dbconn has open, for train_classifier()'s own connection
+	trainer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+	model = None
+	trainingStarted = False # model goes back to None if the training fails. It is not tried again
+	stopped = False
+	prompted = False
+	nTransactions = 0
+	nHitsTotal = 0
+	nAutoApplied = 0
+	queue = [] # (confidence, row, guessed category) of every row batch mode did not write straight away
+	for uncategorized_transactions in iter_uncategorized_transactions(dbconn, account, chunksize): # Each row is TransactionId,Payee,Memo,Amount
+		if batch or stopped: # Nobody is at the prompt, so there is no point in fallback guesses
+			model = wait_for_classifier(model)
+		(guessed_categories, confidences, nHits) = guess_categories(model, lookup, uncategorized_transactions, fallback) # same length as uncategorized_transactions
+		if nHits < len(uncategorized_transactions) and model is None and not trainingStarted:
+			if not has_training_data(dbconn, account, trainingfilename): # Checked here, before anyone is asked about anything
+				print ("Hmm... seems like there are no categorized records available for training. Quitting.")
+				quit()
+			trainingStarted = True
+			model = trainer.submit(train_classifier, sqlitedbfilename, account, trainingfilename, modelcachedir, rebuildmodel, modelcachekeep, backend)
+			if batch or stopped:
+				model = wait_for_classifier(model)
+				(guessed_categories, confidences, nHits) = guess_categories(model, lookup, uncategorized_transactions, fallback)
+			else:
+				print(f'Training the classifier in the background. Until it is ready, transactions the lookup index does not know are guessed as {fallback}.')
+		nTransactions = nTransactions + len(uncategorized_transactions)
+		nHitsTotal = nHitsTotal + nHits
+		print(f'Merchant lookup resolved {nHits} of {len(uncategorized_transactions)} transactions in this chunk. {len(uncategorized_transactions)-nHits} go to the classifier.')
+		if batch:
+			accepted = [i for i in range(len(confidences)) if confidences[i] >= threshold]
+			queue.extend((confidences[i], uncategorized_transactions[i], guessed_categories[i]) for i in range(len(confidences)) if confidences[i] < threshold)
+			write_verified_categories_to_db(dbconn, account, [uncategorized_transactions[i] for i in accepted], [guessed_categories[i] for i in accepted], [''] * len(accepted))
+			nAutoApplied = nAutoApplied + len(accepted)
+			continue
+		if stopped:
+			(verified_categories, notes) = (guessed_categories, [''] * len(guessed_categories))
+		else:
+			if not prompted:
+				print(f'First prompt after {time.perf_counter()-scriptStartTime:.2f}s.')
+				prompted = True
+			with metrics.stage('review'): # Mostly time spent waiting for the user
+				(verified_categories, notes, nVerified) = verify_categories_and_add_notes(dbconn, uncategorized_transactions, guessed_categories, model, lookup, None, fallback)
+			stopped = nVerified < len(uncategorized_transactions)
+			# Nothing is written while the classifier is still reading the categorized transactions, so it trains on (and its cache entry is
+			# keyed by) one consistent set of them. This also means the rows the user did not get to are written with its guesses, not fallback ones
+			model = wait_for_classifier(model)
+			if stopped:
+				(verified_categories[nVerified:], newConfidences, nHits) = guess_categories(model, lookup, uncategorized_transactions[nVerified:], fallback)
+		write_verified_categories_to_db(dbconn, account, uncategorized_transactions, verified_categories, notes)
+	trainer.shutdown()
+	if nTransactions < 1:
 		print(f'There seem to be no uncategorized transactions in {account}. Stopping..')
 		quit()
-	guessed_categories = categorize_transactions(classifier, tfidf, le, uncategorized_transactions) # same length as uncategorized_transactions
-	(verified_categories, notes) = verify_categories_and_add_notes(dbconn, uncategorized_transactions, guessed_categories)
-	write_verified_categories_to_db(dbconn, account, uncategorized_transactions, verified_categories, notes)
+	print(f'Merchant lookup resolved {nHitsTotal} of {nTransactions} uncategorized transactions ({100*nHitsTotal/nTransactions:.1f}% hit rate).')
+	if batch:
+		print(f'Auto-applied {nAutoApplied} of {nTransactions} transactions with confidence >= {threshold:.2f}. {len(queue)} queued for review.')
+		queue.sort(key=lambda queued: queued[0])
+		uncategorized_transactions = [queued[1] for queued in queue]
+		guessed_categories = [queued[2] for queued in queue]
+		confidences = [queued[0] for queued in queue]
+		if len(queue) > 0:
+			print(f'First prompt after {time.perf_counter()-scriptStartTime:.2f}s.')
+		with metrics.stage('review'):
+			(verified_categories, notes, nVerified) = verify_categories_and_add_notes(dbconn, uncategorized_transactions, guessed_categories, model, lookup, confidences)
+		write_verified_categories_to_db(dbconn, account, uncategorized_transactions[:nVerified], verified_categories[:nVerified], notes[:nVerified])
+		print(f'Reviewed {nVerified} of {len(queue)} queued transactions. {len(queue)-nVerified} left Unknown.')
 	
 
+def get_shared_classifier(dbconn, accounts, modelcachedir, rebuildmodel, modelcachekeep, backend):
+	# The classifier of all of accounts, trained on all of their categorized transactions (or loaded from the cache). Returns (classifier, tfidf, le)
+	with metrics.stage('train'):
+		categories = get_valid_categories(dbconn)
+		if is_online_backend(backend):
+			categories = sorted(set(categories).union(*[get_training_categories(dbconn, account, None) for account in accounts]))
+		read_chunks = get_all_accounts_training_chunks(dbconn, accounts)
+		return get_classifier(read_chunks, 'all-accounts', modelcachedir, rebuildmodel, modelcachekeep, backend, categories)
+
+def auto_categorize_all_accounts(dbconn, accounts, modelcachedir, rebuildmodel, modelcachekeep, backend, rebuildlookup, chunksize, batch=False, threshold=0.9):
+	# Same as auto_categorize(), but for the uncategorized transactions of all of accounts together, with one classifier shared by all
+	# of them (see get_shared_classifier()). rowAccounts has the account of each row, which is what tells model_inputs() and
+	# write_verified_categories_by_account() which account it belongs to
+	# Every account's rows are looked up in its own lookup index first. If any are left, the classifier is trained (or loaded) once
+	# and guesses all of them in one pass. Unlike auto_categorize(), nobody is prompted before it is ready: there is one classifier
+	# for the whole backlog, so there is no account whose training could go on in the background while another one is being reviewed
+	# Then review and writing go chunksize rows at a time, as in auto_categorize()
+	lookup = {}
+	uncategorized_transactions = []
+	rowAccounts = []
+	with metrics.stage('lookup'):
+		for account in accounts:
+			ensure_lookup_index(dbconn, account, rebuildlookup)
+			for (description, category) in load_lookup_index(dbconn, account).items():
+				lookup[description+' '+account_word(account)] = category # Keyed like transaction_inputs() of the account's rows
+	for account in accounts:
+		accountTransactions = get_uncategorized_transactions(dbconn, account)
+		uncategorized_transactions.extend(accountTransactions)
+		rowAccounts.extend([account] * len(accountTransactions))
+	if len(uncategorized_transactions) < 1:
+		print(f'There seem to be no uncategorized transactions in any of the accounts. Stopping..')
+		quit()
+	model = None
+	inputs = transaction_inputs(uncategorized_transactions, rowAccounts)
+	if any(description not in lookup for description in inputs):
+		model = get_shared_classifier(dbconn, accounts, modelcachedir, rebuildmodel, modelcachekeep, backend)
+	(guessed_categories, confidences, nHits) = guess_categories(model, lookup, uncategorized_transactions, accounts=rowAccounts)
+	print(f'Merchant lookup resolved {nHits} of {len(uncategorized_transactions)} uncategorized transactions in {len(accounts)} accounts. {len(uncategorized_transactions)-nHits} went to the classifier.')
+	if batch:
+		accepted = [i for i in range(len(confidences)) if confidences[i] >= threshold]
+		write_verified_categories_by_account(dbconn, [rowAccounts[i] for i in accepted], [uncategorized_transactions[i] for i in accepted], [guessed_categories[i] for i in accepted], [''] * len(accepted))
+		queue = sorted((confidences[i], uncategorized_transactions[i], guessed_categories[i], rowAccounts[i]) for i in range(len(confidences)) if confidences[i] < threshold)
+		print(f'Auto-applied {len(accepted)} of {len(uncategorized_transactions)} transactions with confidence >= {threshold:.2f}. {len(queue)} queued for review.')
+		uncategorized_transactions = [queued[1] for queued in queue]
+		guessed_categories = [queued[2] for queued in queue]
+		rowAccounts = [queued[3] for queued in queue]
+		confidences = [queued[0] for queued in queue]
+	else:
+		confidences = None
+	stopped = False
+	nReviewed = 0
+	for start in range(0, len(uncategorized_transactions), chunksize):
+		chunk = uncategorized_transactions[start:start+chunksize]
+		chunkAccounts = rowAccounts[start:start+chunksize]
+		chunkGuesses = guessed_categories[start:start+chunksize]
+		if stopped:
+			if batch: # Queued rows nobody got to stay Unknown, as in auto_categorize()
+				break
+			(verified_categories, notes, nVerified) = (chunkGuesses, [''] * len(chunk), 0)
+		else:
+			if nReviewed == 0:
+				print(f'First prompt after {time.perf_counter()-scriptStartTime:.2f}s.')
+			with metrics.stage('review'):
+				(verified_categories, notes, nVerified) = verify_categories_and_add_notes(dbconn, chunk, chunkGuesses, model, lookup, None if confidences is None else confidences[start:start+chunksize], accounts=chunkAccounts)
+			stopped = nVerified < len(chunk)
+			nReviewed = nReviewed + nVerified
+		written = nVerified if batch else len(chunk)
+		write_verified_categories_by_account(dbconn, chunkAccounts[:written], chunk[:written], verified_categories[:written], notes[:written])
+	if batch:
+		print(f'Reviewed {nReviewed} of {len(uncategorized_transactions)} queued transactions. {len(uncategorized_transactions)-nReviewed} left Unknown.')
+
 def parseargs():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('sqlitedbfile', help="SQLite database. Expected to have extention .db")
-	parser.add_argument('account', help="Name of the institution whose transactions should be categorized")
+	parser.add_argument('account', nargs='?', default=None, help="Name of the institution whose transactions should be categorized")
+	parser.add_argument('-a', '--all-accounts', action='store_true', help="Categorize the transactions of every account instead of just one, with one classifier trained on all of them")
 	parser.add_argument('-t', '--trainingfile', default=None, help="Name of input csv file with Description,Category cols used for training")
+	parser.add_argument('-m', '--model-cache', default=None, help="Directory where trained classifiers are cached. Default is model-cache/ next to the sqlite db. Pass 'none' to turn the cache off")
+	parser.add_argument('-r', '--rebuild-model', action='store_true', help="Retrain the classifier even if a cached one matches the training data")
+	parser.add_argument('--model-cache-keep', type=int, default=2, help="Number of cached classifiers kept per account/training file. Older ones are deleted. Default is 2")
+	parser.add_argument('-l', '--rebuild-lookup', action='store_true', help="Rebuild the merchant lookup index from the categorized transactions before using it")
+	parser.add_argument('-k', '--chunk-size', type=int, default=1000, help="Number of uncategorized transactions read, guessed and written back at a time. Default is 1000")
+	parser.add_argument('--batch', action='store_true', help="Write guesses that are at least --threshold confident without asking, and only ask about the rest, least confident first")
+	parser.add_argument('--threshold', type=float, default=0.9, help="Confidence (0 to 1) a guess needs to be written without asking in --batch mode. Default is 0.9")
+	parser.add_argument('-c', '--classifier', choices=sorted(classifier_backends), default='forest', help="Classifier backend. forest (default) is a random forest. sgd (logistic regression) and nb (naive Bayes) are online: they learn from each correction as you make it")
+	metrics.add_arguments(parser)
 	args = parser.parse_args()
-	return(args.sqlitedbfile, args.account, args.trainingfile)
-
-def verify_account(account):
-	valid_accounts = ['AmexBlueCash', 'ChaseSapphireReserve', 'TechCUChecking', 'TechCUSavings', 'BofAChecking', 'BofASavings']
-	if account in valid_accounts:
-		return True
-	else:
-		return False
-
-# TODO: Add error checking to this function
-def open_sqlite_db(sqlitedbfilename):
-	# TODO: Verify sqlitedbfilename exists?
-	dbconn = sqlite3.connect(sqlitedbfilename)
-	# TODO: Verify connect is successful?
-	return dbconn
+	if (args.account is None) == (not args.all_accounts):
+		parser.error('Give either an account or --all-accounts')
+	if args.all_accounts and args.trainingfile:
+		parser.error('--trainingfile cannot be used with --all-accounts, which trains on the categorized transactions of every account')
+	if args.model_cache_keep < 1:
+		parser.error('--model-cache-keep has to be at least 1, the classifier that was just cached')
+	if not 0 <= args.threshold <= 1:
+		parser.error('--threshold has to be between 0 and 1, e.g. 0.8 for 80% sure')
+	modelcachedir = args.model_cache
+	if modelcachedir is None:
+		modelcachedir = os.path.join(os.path.dirname(os.path.abspath(args.sqlitedbfile)), 'model-cache')
+	elif modelcachedir.lower() == 'none':
+		modelcachedir = None
+	return(args.sqlitedbfile, args.account, args.all_accounts, args.trainingfile, modelcachedir, args.rebuild_model, args.model_cache_keep, args.classifier, args.rebuild_lookup, args.chunk_size, args.batch, args.threshold, args.metrics, args.profile)
 
 def main():
-	(sqlitedbfilename, account, trainingfilename) = parseargs()
-	if verify_account(account) == False:
+	(sqlitedbfilename, account, allaccounts, trainingfilename, modelcachedir, rebuildmodel, modelcachekeep, backend, rebuildlookup, chunksize, batch, threshold, metricsfilename, profilestage) = parseargs()
+	metrics.enable('autocategorize.py', metricsfilename, profilestage)
+	if not allaccounts and moneydb.verify_account(account) == False:
 		print(f'Unknown account: {account}. Stopping..')
 		quit()
-	dbconn = open_sqlite_db(sqlitedbfilename)
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	if allaccounts:
+		auto_categorize_all_accounts(dbconn, moneydb.valid_accounts, modelcachedir, rebuildmodel, modelcachekeep, backend, rebuildlookup, chunksize, batch, threshold)
+		dbconn.close()
+		return
 	# TODO: Error checking of auto_categorize() below
 	# If trainingfilename is valid, auto_categorize() will use its content for training. Else it'll use already categorized transactions in account for training
-	auto_categorize(dbconn, account, trainingfilename)
+	auto_categorize(dbconn, account, trainingfilename, modelcachedir, rebuildmodel, modelcachekeep, backend, rebuildlookup, chunksize, batch, threshold)
 	dbconn.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+# This script is called as: python3 benchmark-preprocess.py [-n 10000 100000]
+# It checks that autocategorize.py's preprocess_description() and preprocess_descriptions() give exactly the same output as the original
+# un-precompiled, un-memoized preprocess_description() (copied below as legacy_preprocess_description), and times all three on synthetic
+# payee + memo descriptions. The memo is cleared before each timing, so every run starts cold
+# Exits with status 1 if any description comes out differently
+
+import argparse
+import random
+import re
+import sys
+import time
+
+import autocategorize
+
+# This is preprocess_description() as it was before the patterns were precompiled and the batch version was added. Do not change it
+def legacy_preprocess_description(description):
+	# Remove all special characters
+	document = re.sub(r'\W', ' ', description)
+	# Remove all words containing numbers
+	document = re.sub(r'\w*\d\w*', '', document).strip()
+	# Remove all single characters
+	document = re.sub(r"\b[a-zA-Z]\b", '', document)
+	# Alt. remove all single chars
+	document = re.sub(r'\s+[a-zA-Z]\s+', ' ', document)
+	# Remove all single chars from start
+	document = re.sub(r'\^[a-zA-Z]\s+', ' ', document)
+	# Substitute multiple spaces with single space
+	document = re.sub(r'\s+', ' ', document, flags=re.I)
+	# Convert string to lower case
+	document = document.lower()
+	# Remove "aplpay" and "com" (for .com) from string
+	document = document.replace('aplpay ', '')
+	document = document.replace('com', '')
+	return document
+
+def make_descriptions(n, seed=0):
+	# Payee + ' ' + memo strings roughly like the ones in the db: a few hundred merchants, a handful of them making up most of the
+	# transactions, each with a few store numbers and memos, plus punctuation, single letters, .com and APLPAY prefixes
+	# A small share get a unique reference number, like one-off online payments do
+	rng = random.Random(seed)
+	merchants = ['STARBUCKS', 'AMAZON.COM*', 'SAFEWAY', 'TRADER JOE S', 'SHELL OIL', 'NETFLIX.COM', 'WHOLEFDS', 'COSTCO WHSE', 'CHEVRON', 'UBER   TRIP',
+		'LYFT *RIDE', 'PG&E WEBONLINE', 'COMCAST CALIFORNIA', 'SQ *BLUE BOTTLE', 'TST* IN-N-OUT', 'CVS/PHARMACY', 'TARGET T-', 'BEST BUY', 'APLPAY PEETS', 'Zelle payment to J Doe']
+	merchants = merchants + [f'MERCHANT {chr(65 + i % 26)}{chr(65 + i // 26 % 26)} STORE' for i in range(400)]
+	memos = ['', 'SAN JOSE CA', 'ONLINE PMT', 'x1234', 'Ref #A1B2C3', 'POS DEBIT 04/12', 'a b c', 'WWW.EXAMPLE.COM']
+	descriptions = []
+	for i in range(n):
+		merchant = merchants[min(int(rng.paretovariate(1.2)) - 1, len(merchants) - 1)]
+		if rng.random() < 0.05:
+			descriptions.append(f'{merchant} REF{rng.randint(1, 9999999)} {rng.choice(memos)}')
+		else:
+			descriptions.append(f'{merchant} #{rng.randint(1, 20)} {rng.choice(memos)}')
+	return descriptions
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[10000, 100000], help="Numbers of descriptions to benchmark with. Default is 10000 100000")
+	args = parser.parse_args()
+	mismatches = 0
+	for n in args.sizes:
+		descriptions = make_descriptions(n)
+		start = time.perf_counter()
+		expected = [legacy_preprocess_description(x) for x in descriptions]
+		legacyTime = time.perf_counter() - start
+		autocategorize.preprocess_description.cache_clear()
+		start = time.perf_counter()
+		memoized = [autocategorize.preprocess_description(x) for x in descriptions]
+		memoizedTime = time.perf_counter() - start
+		autocategorize.preprocess_description.cache_clear()
+		start = time.perf_counter()
+		batch = autocategorize.preprocess_descriptions(descriptions)
+		batchTime = time.perf_counter() - start
+		for (description, want, got1, got2) in zip(descriptions, expected, memoized, batch):
+			if got1 != want or got2 != want:
+				mismatches = mismatches + 1
+				if mismatches <= 10:
+					print(f'MISMATCH for {description!r}: expected {want!r}, memoized gave {got1!r}, batch gave {got2!r}')
+		nDistinct = len(set(descriptions))
+		print(f'{n} descriptions ({nDistinct} distinct):')
+		print(f'  original one at a time: {legacyTime:.3f}s')
+		print(f'  memoized one at a time: {memoizedTime:.3f}s ({legacyTime/memoizedTime:.1f}x)')
+		print(f'  preprocess_descriptions: {batchTime:.3f}s ({legacyTime/batchTime:.1f}x)')
+	if mismatches > 0:
+		print(f'{mismatches} descriptions were preprocessed differently. FAIL')
+		sys.exit(1)
+	print('All outputs identical to the original preprocess_description().')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# This script is called as: python3 benchmark.py [-n 1000 10000 100000] [-s ingest train categorize export] [-c forest]
+# It measures how the pipeline scales on synthetic data, and appends the results to benchmark-results.jsonl (see -o) so they can be
+# compared across commits. python3 benchmark.py --report prints that comparison
+# For each size (number of transactions), it first generates (once, they are kept in benchmark-data/, see -d)
+# - one OFX file per account, the transactions spread over the six accounts in moneydb.valid_accounts like a real household's would be
+# - a db like sqlite-database.db with the same number of transactions, all of them categorized and none of them in Google Sheets yet
+# Payees and memos follow a long-tailed distribution: a few merchants make up most of the transactions, and there is a long tail of
+# ones that only show up a few times, like in real statements
+# Then it times these stages, each in a fresh process so that its peak memory use is its own
+# - ingest: write_transactions_to_db() from ofx-to-sqlite.py, fed from the OFX files by its streaming reader, into an empty db
+# - train: get_trained_classifier() from autocategorize.py on all of the categorized transactions
+# - categorize: categorize_transactions() from autocategorize.py on as many new transactions, with the classifier from train
+# - export: update_gsheets() from sqlite-to-gsheets.py for all accounts, to a LocalSheet with no quota, so only our side is timed
+# Only the stage itself is timed. Peak RSS is for the whole process, so it includes whatever the stage needed loaded (e.g. the training data)
+
+import argparse
+import contextlib
+import datetime
+import html
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import moneydb
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+stages = ['ingest', 'train', 'categorize', 'export']
+
+# The <ORG> and <ACCTTYPE> of each account's OFX files, see account_name_for() in ofx-to-sqlite.py. Credit cards have no ACCTTYPE
+accountOfxIds = {'AmexBlueCash': ('AMEX', ''), 'ChaseSapphireReserve': ('B1', ''), 'TechCUChecking': ('Tech CU', 'CHECKING'), 'TechCUSavings': ('Tech CU', 'SAVINGS'), 'BofAChecking': ('Bank of America', 'CHECKING'), 'BofASavings': ('Bank of America', 'MONEYMRKT')}
+# Share of all transactions that are in each account. The credit cards get most of the day to day spending
+accountShares = {'AmexBlueCash': 0.35, 'ChaseSapphireReserve': 0.3, 'TechCUChecking': 0.15, 'TechCUSavings': 0.05, 'BofAChecking': 0.1, 'BofASavings': 0.05}
+# The merchants that make up most of the transactions, by category
+merchantsByCategory = {
+	'Coffee': ['STARBUCKS', 'PEETS', 'SQ *BLUE BOTTLE', 'PHILZ COFFEE'],
+	'Groceries': ['SAFEWAY', 'TRADER JOE S', 'WHOLEFDS', 'COSTCO WHSE', 'SPROUTS FARMERS MKT'],
+	'Gas': ['SHELL OIL', 'CHEVRON', 'ARCO', 'COSTCO GAS'],
+	'Shopping': ['AMAZON.COM*', 'TARGET T-', 'BEST BUY', 'CVS/PHARMACY', 'HOME DEPOT'],
+	'Entertainment': ['NETFLIX.COM', 'SPOTIFY USA', 'AMC THEATRES', 'STEAMGAMES.COM'],
+	'Restaurants': ['TST* IN-N-OUT', 'CHIPOTLE', 'PANDA EXPRESS', 'DOORDASH*', 'UBER   EATS'],
+	'Travel': ['UNITED AIRLINES', 'MARRIOTT', 'LYFT *RIDE', 'UBER   TRIP'],
+	'Utilities': ['PG&E WEBONLINE', 'COMCAST CALIFORNIA', 'AT&T*BILL PAYMENT'],
+	'Transfer': ['ONLINE TRANSFER', 'Zelle payment to J Doe', 'AUTOPAY PAYMENT'],
+	'Interest': ['INTEREST EARNED', 'DIVIDEND'],
+}
+memos = ['', 'SAN JOSE CA', 'MOUNTAIN VIEW CA', 'ONLINE PMT', 'POS DEBIT', 'RECURRING', 'WWW.EXAMPLE.COM', 'APLPAY']
+
+def get_merchants(seed=0):
+	# The list of (merchant, category) transactions are drawn from, most common first: the well known merchants above in random
+	# order, then a long tail of 2000 small ones
+	rng = random.Random(seed)
+	merchants = [(merchant, category) for (category, categoryMerchants) in merchantsByCategory.items() for merchant in categoryMerchants]
+	rng.shuffle(merchants)
+	categories = sorted(merchantsByCategory)
+	for i in range(2000):
+		merchants.append((f'MERCHANT {chr(65 + i % 26)}{chr(65 + i // 26 % 26)}{i // 676} STORE', rng.choice(categories)))
+	return merchants
+
+def iter_synthetic_transactions(account, n, seed=0):
+	# Generator of n (TransactionId, DatePosted, Payee, Amount, Memo, Category) rows for account, posted over two years
+	# Merchants are picked with a Pareto distribution over get_merchants(), so a handful of them come up over and over again
+	rng = random.Random(f'{account}-{seed}')
+	merchants = get_merchants()
+	firstDay = datetime.date(2022, 1, 1)
+	for i in range(n):
+		(merchant, category) = merchants[min(int(rng.paretovariate(1.1)) - 1, len(merchants) - 1)]
+		payee = f'{merchant} #{rng.randint(1, 40)}' if rng.random() < 0.7 else merchant
+		datePosted = (firstDay + datetime.timedelta(days=rng.randint(0, 729))).strftime('%Y-%m-%d')
+		amount = round(rng.lognormvariate(3, 1.2), 2) * (1 if category == 'Interest' else -1)
+		yield (f'{seed}{i:09d}', datePosted, payee, amount, rng.choice(memos), category)
+
+def account_sizes(n):
+	# How many of n transactions go in each account
+	sizes = {account: int(n * share) for (account, share) in accountShares.items()}
+	sizes['AmexBlueCash'] = sizes['AmexBlueCash'] + n - sum(sizes.values())
+	return sizes
+
+def write_ofx_file(ofxfilename, account, transactions):
+	# Writes transactions (see iter_synthetic_transactions()) as an OFX 1.x statement of account, one at a time
+	(organization, accountType) = accountOfxIds[account]
+	if accountType:
+		(header, footer) = ('<BANKMSGSRSV1><STMTTRNRS><TRNUID>1<STATUS><CODE>0<SEVERITY>INFO</STATUS><STMTRS><CURDEF>USD\n<BANKACCTFROM><BANKID>1<ACCTID>1234<ACCTTYPE>'+accountType+'</BANKACCTFROM>', '</STMTRS></STMTTRNRS></BANKMSGSRSV1>')
+	else:
+		(header, footer) = ('<CREDITCARDMSGSRSV1><CCSTMTTRNRS><TRNUID>1<STATUS><CODE>0<SEVERITY>INFO</STATUS><CCSTMTRS><CURDEF>USD\n<CCACCTFROM><ACCTID>1234</CCACCTFROM>', '</CCSTMTRS></CCSTMTTRNRS></CREDITCARDMSGSRSV1>')
+	with open(ofxfilename, 'w') as ofxfile:
+		ofxfile.write('OFXHEADER:100\nDATA:OFXSGML\nVERSION:102\nSECURITY:NONE\nENCODING:USASCII\nCHARSET:1252\nCOMPRESSION:NONE\nOLDFILEUID:NONE\nNEWFILEUID:NONE\n\n')
+		ofxfile.write('<OFX>\n<SIGNONMSGSRSV1><SONRS><STATUS><CODE>0<SEVERITY>INFO</STATUS><DTSERVER>20240101<LANGUAGE>ENG<FI><ORG>'+html.escape(organization)+'<FID>1</FI></SONRS></SIGNONMSGSRSV1>\n')
+		ofxfile.write(header+'\n<BANKTRANLIST><DTSTART>20220101<DTEND>20231231\n')
+		for (transactionId, datePosted, payee, amount, memo, category) in transactions:
+			ofxfile.write(f'<STMTTRN>\n<TRNTYPE>{"CREDIT" if amount > 0 else "DEBIT"}\n<DTPOSTED>{datePosted.replace("-", "")}120000.000[-8:PST]\n<TRNAMT>{amount:.2f}\n<FITID>{transactionId}\n<NAME>{html.escape(payee)}\n<MEMO>{html.escape(memo)}\n</STMTTRN>\n')
+		ofxfile.write('</BANKTRANLIST>\n<LEDGERBAL><BALAMT>1234.56<DTASOF>20231231</LEDGERBAL>\n'+footer+'\n</OFX>\n')
+
+def make_categorized_db(dbfilename, n):
+	# A copy of sqlite-database.db with n categorized transactions spread over the accounts, none of them in Google Sheets yet
+	shutil.copy(os.path.join(scriptDir, 'sqlite-database.db'), dbfilename)
+	dbconn = moneydb.open_sqlite_db(dbfilename)
+	with moneydb.write_transaction(dbconn):
+		dbconn.executemany('''INSERT OR IGNORE INTO Categories("Category", "Group", "Type") VALUES (?,?,?)''', [(category, 'Benchmark', 'Expense') for category in sorted(merchantsByCategory) + ['Unknown']])
+		for (account, size) in account_sizes(n).items():
+			dbconn.executemany(moneydb.account_sql('''INSERT INTO {Trans}("TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes") VALUES (?,?,?,?,?,?,'')''', account), iter_synthetic_transactions(account, size))
+			dbconn.execute(moneydb.account_sql('''INSERT INTO {Meta}("TransactionId", "DBTimestamp", "IsInGSheets") SELECT "TransactionId", '2024-01-01 00:00:00.000000', 0 FROM {Trans}''', account))
+	dbconn.close()
+
+def prepare_data(datadir, n):
+	# Generates the OFX files and categorized db for n transactions in datadir, unless they are there already from an earlier run
+	ofxdir = os.path.join(datadir, f'ofx-{n}')
+	if not os.path.isdir(ofxdir):
+		print(f'Generating OFX files with {n} transactions..')
+		os.makedirs(ofxdir+'.tmp', exist_ok=True)
+		for (account, size) in account_sizes(n).items():
+			write_ofx_file(os.path.join(ofxdir+'.tmp', account+'.ofx'), account, iter_synthetic_transactions(account, size))
+		os.replace(ofxdir+'.tmp', ofxdir)
+	dbfilename = os.path.join(datadir, f'categorized-{n}.db')
+	if not os.path.exists(dbfilename):
+		print(f'Generating a db with {n} categorized transactions..')
+		make_categorized_db(dbfilename+'.tmp', n)
+		os.replace(dbfilename+'.tmp', dbfilename)
+	return (ofxdir, dbfilename)
+
+def load_training_data(dbconn):
+	# All of the categorized transactions of every account in one DataFrame, see fetch_training_data() in autocategorize.py
+	import pandas as pd
+	autocategorize = moneydb.load_script('autocategorize.py')
+	return pd.concat([autocategorize.fetch_training_data(dbconn, account, None) for account in moneydb.valid_accounts], ignore_index=True)
+
+def time_stage(stage, ofxdir, dbfilename, workdir, backend):
+	# Runs stage once and returns how many seconds it took. Setting up for it (loading modules, copying dbs, loading training data)
+	# is not part of the time. The scripts' own output goes to /dev/null
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		if stage == 'ingest':
+			ofxtosqlite = moneydb.load_script('ofx-to-sqlite.py')
+			shutil.copy(os.path.join(scriptDir, 'sqlite-database.db'), os.path.join(workdir, 'ingest.db'))
+			dbconn = moneydb.open_sqlite_db(os.path.join(workdir, 'ingest.db'))
+			elapsed = 0
+			for account in moneydb.valid_accounts:
+				rows = ofxtosqlite.open_ofx_stream(os.path.join(ofxdir, account+'.ofx'))[3]
+				start = time.perf_counter()
+				ofxtosqlite.write_transactions_to_db(rows, dbconn, account)
+				elapsed = elapsed + time.perf_counter() - start
+			return elapsed
+		if stage == 'train' or stage == 'categorize':
+			autocategorize = moneydb.load_script('autocategorize.py')
+			dbconn = moneydb.open_sqlite_db(dbfilename)
+			df = load_training_data(dbconn)
+			start = time.perf_counter()
+			(classifier, tfidf, le) = autocategorize.get_trained_classifier(df, backend)
+			if stage == 'train':
+				return time.perf_counter() - start
+			# New transactions, as TransactionId,Payee,Memo,Amount rows like get_uncategorized_transactions() gives
+			newTransactions = [(row[0], row[2], row[4], row[3]) for row in iter_synthetic_transactions('AmexBlueCash', len(df), seed=1)]
+			start = time.perf_counter()
+			autocategorize.categorize_transactions(classifier, tfidf, le, newTransactions)
+			return time.perf_counter() - start
+		if stage == 'export':
+			sqlitetogsheets = moneydb.load_script('sqlite-to-gsheets.py')
+			shutil.copy(dbfilename, os.path.join(workdir, 'export.db'))
+			dbconn = moneydb.open_sqlite_db(os.path.join(workdir, 'export.db'))
+			sheet = sqlitetogsheets.LocalSheet(os.path.join(workdir, 'export.csv'), quotaperminute=float('inf'))
+			start = time.perf_counter()
+			sqlitetogsheets.update_gsheets(dbconn, moneydb.valid_accounts, sheet, 500, sqlitetogsheets.RateLimiter(float('inf'), float('inf')))
+			return time.perf_counter() - start
+	raise ValueError(f'Unknown stage {stage}')
+
+def run_stage(stage, ofxdir, dbfilename, backend, results):
+	# What each benchmark process runs. Puts (seconds, peak RSS in bytes, None) on results, or (None, None, error) if the stage failed
+	try:
+		with tempfile.TemporaryDirectory() as workdir:
+			elapsed = time_stage(stage, ofxdir, dbfilename, workdir, backend)
+	except BaseException as e: # Including SystemExit, e.g. from a quit() in one of the scripts
+		results.put((None, None, repr(e)))
+		return
+	peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform != 'darwin':
+		peakRss = peakRss * 1024 # Linux reports it in KiB, macOS in bytes
+	results.put((elapsed, peakRss, None))
+
+def wait_for_stage(process, results):
+	# What run_stage() put on results, or (None, None, error) if the process died without putting anything there (e.g. killed for
+	# running out of memory, or failed to import something before run_stage() even started)
+	while True:
+		try:
+			return results.get(timeout=1)
+		except queue.Empty:
+			if not process.is_alive():
+				try:
+					return results.get(timeout=1) # In case it put its result just before exiting
+				except queue.Empty:
+					return (None, None, f'the benchmark process exited with code {process.exitcode}')
+
+def get_commit():
+	# The git commit being benchmarked, with -dirty if there are uncommitted changes to the scripts
+	try:
+		commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=scriptDir, capture_output=True, text=True, check=True).stdout.strip()
+		dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=scriptDir, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+	return commit+'-dirty' if dirty else commit
+
+def print_report(resultsfilename, ncommits):
+	# A table of seconds (and rows/sec) for each stage and size, one column for each of the last ncommits commits benchmarked
+	# If a commit was benchmarked more than once, its latest result counts
+	results = []
+	with open(resultsfilename) as resultsfile:
+		for line in resultsfile:
+			if line.strip():
+				results.append(json.loads(line))
+	commits = []
+	for result in results:
+		if result['commit'] in commits:
+			commits.remove(result['commit'])
+		commits.append(result['commit'])
+	commits = commits[-ncommits:]
+	latest = {(result['commit'], result['stage'], result['size'], result['classifier']): result for result in results}
+	keys = sorted({(result['stage'], result['size'], result['classifier']) for result in results}, key=lambda key: (stages.index(key[0]) if key[0] in stages else len(stages), key[1], key[2]))
+	print(f'{"stage":<20}{"size":>9}  ' + ''.join(f'{commit:>26}' for commit in commits))
+	for (stage, size, classifier) in keys:
+		cells = []
+		for commit in commits:
+			result = latest.get((commit, stage, size, classifier))
+			cells.append(f'{result["seconds"]:>9.2f}s {result["rowsPerSec"]:>9.0f}/s {result["peakRssMB"]:>4.0f}M' if result else f'{"-":>26}')
+		label = stage if stage == 'ingest' or stage == 'export' else f'{stage}/{classifier}'
+		print(f'{label:<20}{size:>9}  ' + ''.join(f'{cell:>26}' for cell in cells))
+
+def parseargs():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Numbers of transactions to benchmark with. Default is 1000 10000 100000. 1000000 works too, but training a forest on it takes a while")
+	parser.add_argument('-s', '--stages', nargs='+', choices=stages, default=stages, help="Stages to benchmark. Default is all of them")
+	parser.add_argument('-c', '--classifier', choices=sorted(moneydb.load_script('autocategorize.py').classifier_backends), default='forest', help="Classifier backend for train and categorize, see autocategorize.py --classifier. Default is forest")
+	parser.add_argument('-d', '--data-dir', default=os.path.join(scriptDir, 'benchmark-data'), help="Where the generated OFX files and dbs are kept between runs. Default is benchmark-data/ next to this script")
+	parser.add_argument('-o', '--results', default=os.path.join(scriptDir, 'benchmark-results.jsonl'), help="File the results are appended to, one JSON object per line. Default is benchmark-results.jsonl next to this script")
+	parser.add_argument('--report', action='store_true', help="Do not benchmark anything, just print the results in --results side by side for the last few commits")
+	parser.add_argument('--report-commits', type=int, default=4, help="Number of commits --report compares. Default is 4")
+	args = parser.parse_args()
+	return (args.sizes, args.stages, args.classifier, args.data_dir, args.results, args.report, args.report_commits)
+
+def main():
+	(sizes, benchmarkstages, backend, datadir, resultsfilename, report, reportcommits) = parseargs()
+	if report:
+		print_report(resultsfilename, reportcommits)
+		return
+	commit = get_commit()
+	# spawn, not fork, so each stage starts from a fresh interpreter and its peak RSS is not inherited from this one
+	context = multiprocessing.get_context('spawn')
+	for n in sizes:
+		(ofxdir, dbfilename) = prepare_data(datadir, n)
+		for stage in benchmarkstages:
+			results = context.Queue()
+			process = context.Process(target=run_stage, args=(stage, ofxdir, dbfilename, backend, results))
+			process.start()
+			(elapsed, peakRss, error) = wait_for_stage(process, results)
+			process.join()
+			if error is not None:
+				print(f'{stage:<11}{n:>9} transactions: failed ({error}). Not recorded.')
+				continue
+			result = {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'), 'stage': stage, 'size': n, 'classifier': backend,
+				'seconds': round(elapsed, 4), 'rowsPerSec': round(n / max(elapsed, 1e-9), 1), 'peakRssMB': round(peakRss / 2**20, 1),
+				'python': platform.python_version(), 'machine': platform.machine()}
+			print(f'{stage:<11}{n:>9} transactions: {elapsed:8.2f}s {result["rowsPerSec"]:>11.0f} rows/s, peak RSS {result["peakRssMB"]:.0f}MB')
+			with open(resultsfilename, 'a') as resultsfile:
+				resultsfile.write(json.dumps(result)+'\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# Optional instrumentation shared by the scripts: how long each stage of a run took, how many rows went through it, peak memory,
+# and how many db queries ran and how long they took. Turned on with --metrics FILE (see add_arguments()), which appends one JSON
+# object per run to FILE. With --profile STAGE, that one stage also runs under cProfile
+# This is not a script, the other scripts import it. Keep it next to them
+# When it is off, stage() and count() return right away and connections are plain sqlite3 ones, so it costs next to nothing
+
+import atexit
+import contextlib
+import cProfile
+import datetime
+import json
+import pstats
+import resource
+import sqlite3
+import sys
+import threading
+import time
+
+enabled = False
+scriptName = None
+metricsFilename = None
+profileStage = None
+profiler = None
+profilerThread = None # The thread profiler is running on, if it is running. cProfile only sees the thread that turned it on
+startTime = None
+startDate = None
+lock = threading.Lock() # Stages also run on background threads (training, reading batches to upload)
+stages = {} # stage -> {'seconds': total seconds, 'calls': times it ran, 'peakRssMB': peak RSS of the process when it last finished}
+counters = {} # name -> total, e.g. rows written
+queries = {} # SQL statement -> [times run, total seconds]
+
+def add_arguments(parser):
+	parser.add_argument('--metrics', default=None, metavar='FILE', help="Append timings of each stage, row counts, peak memory and db query stats of this run to FILE, as one JSON object per line")
+	parser.add_argument('--profile', default=None, metavar='STAGE', help="Run STAGE under cProfile. The stats go to FILE.STAGE.prof (or STAGE.prof without --metrics) and the top functions are printed at the end")
+
+def enable(script, metricsfilename, profilestage=None):
+	# Turns metrics on for the rest of the run if metricsfilename or profilestage is given. The report is written when the script exits
+	# Call it before opening the db, so that its connections time their queries (see moneydb.open_sqlite_db())
+	global enabled, scriptName, metricsFilename, profileStage, profiler, startTime, startDate
+	if metricsfilename is None and profilestage is None:
+		return
+	enabled = True
+	scriptName = script
+	metricsFilename = metricsfilename
+	profileStage = profilestage
+	if profilestage is not None:
+		profiler = cProfile.Profile()
+	startTime = time.perf_counter()
+	startDate = datetime.datetime.now().isoformat(timespec='seconds')
+	atexit.register(write_report) # So the report is written however the script ends, including quit()
+
+def peak_rss_mb():
+	peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peakRss / 2**20 if sys.platform == 'darwin' else peakRss / 2**10 # Linux reports it in KiB, macOS in bytes
+
+@contextlib.contextmanager
+def stage(name):
+	# with metrics.stage('parse'): adds the time the block takes to stage name. Stages can be nested, and can overlap when they run on
+	# different threads, so they do not have to add up to the total time of the run
+	global profilerThread
+	if not enabled:
+		yield
+		return
+	profiling = False
+	if name == profileStage:
+		with lock:
+			if profilerThread is None:
+				profilerThread = threading.current_thread()
+				profiling = True
+	if profiling:
+		profiler.enable()
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		elapsed = time.perf_counter() - start
+		if profiling:
+			profiler.disable()
+			with lock:
+				profilerThread = None
+		with lock:
+			stats = stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'peakRssMB': 0.0})
+			stats['seconds'] = stats['seconds'] + elapsed
+			stats['calls'] = stats['calls'] + 1
+			stats['peakRssMB'] = round(peak_rss_mb(), 1)
+
+def count(name, n=1):
+	# Adds n to counter name, e.g. metrics.count('rowsWritten', len(batch))
+	if not enabled:
+		return
+	with lock:
+		counters[name] = counters.get(name, 0) + n
+
+def record_query(sql, elapsed, runs=1):
+	with lock:
+		stats = queries.setdefault(sql, [0, 0.0])
+		stats[0] = stats[0] + runs
+		stats[1] = stats[1] + elapsed
+
+class TimedCursor(sqlite3.Cursor):
+	# A cursor that records how long each statement takes, including fetching its rows with fetchone()/fetchmany()/fetchall()
+	# Rows fetched by iterating over the cursor are not timed, since that would mean a Python call per row
+	def execute(self, sql, parameters=()):
+		self.lastSql = sql
+		start = time.perf_counter()
+		try:
+			return super().execute(sql, parameters)
+		finally:
+			record_query(sql, time.perf_counter() - start)
+
+	def executemany(self, sql, seqOfParameters):
+		self.lastSql = sql
+		start = time.perf_counter()
+		try:
+			return super().executemany(sql, seqOfParameters)
+		finally:
+			record_query(sql, time.perf_counter() - start)
+
+	def fetch_timed(self, fetch, *args):
+		start = time.perf_counter()
+		try:
+			return fetch(*args)
+		finally:
+			record_query(getattr(self, 'lastSql', '(fetch)'), time.perf_counter() - start, runs=0)
+
+	def fetchone(self):
+		return self.fetch_timed(super().fetchone)
+
+	def fetchmany(self, size=None):
+		return self.fetch_timed(super().fetchmany, self.arraysize if size is None else size)
+
+	def fetchall(self):
+		return self.fetch_timed(super().fetchall)
+
+class TimedConnection(sqlite3.Connection):
+	# The connection class moneydb.open_sqlite_db() uses when metrics are on. sqlite3's own dbconn.execute() and executemany() make
+	# a plain cursor without calling cursor(), so they are overridden to go through a TimedCursor too
+	def cursor(self, factory=TimedCursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		return self.cursor().execute(sql, parameters)
+
+	def executemany(self, sql, seqOfParameters):
+		return self.cursor().executemany(sql, seqOfParameters)
+
+def connection_factory():
+	# What to pass as sqlite3.connect(factory=...)
+	return TimedConnection if enabled else sqlite3.Connection
+
+def write_report():
+	if not enabled:
+		return
+	# The metrics file is written first, so that it is not lost if printing the profile fails (e.g. stdout is a closed pipe), and
+	# the profile is still saved if writing the metrics file fails
+	try:
+		if metricsFilename is not None:
+			write_metrics_file()
+	finally:
+		if profiler is not None:
+			write_profile()
+
+def write_metrics_file():
+	with lock:
+		slowest = sorted(queries.items(), key=lambda query: query[1][1], reverse=True)[:20]
+		report = {
+			'script': scriptName,
+			'argv': sys.argv[1:],
+			'start': startDate,
+			'seconds': round(time.perf_counter() - startTime, 4),
+			'peakRssMB': round(peak_rss_mb(), 1),
+			'stages': {name: dict(stats, seconds=round(stats['seconds'], 4)) for (name, stats) in stages.items()},
+			'counters': dict(counters),
+			'queries': {
+				'count': sum(stats[0] for stats in queries.values()),
+				'seconds': round(sum(stats[1] for stats in queries.values()), 4),
+				'slowest': [{'sql': ' '.join(sql.split()), 'count': stats[0], 'seconds': round(stats[1], 4)} for (sql, stats) in slowest],
+			},
+		}
+	with open(metricsFilename, 'a') as metricsfile:
+		metricsfile.write(json.dumps(report)+'\n')
+	print(f'Metrics appended to {metricsFilename}.')
+
+def write_profile():
+	profilefilename = (metricsFilename if metricsFilename else scriptName.rsplit('.', 1)[0]) + '.' + profileStage + '.prof'
+	profiler.dump_stats(profilefilename)
+	print(f'Profile of stage {profileStage} saved as {profilefilename}. Top functions by cumulative time:')
+	try:
+		pstats.Stats(profilefilename).sort_stats('cumulative').print_stats(20)
+	except TypeError: # The stage never ran, so there are no stats
+		print('(none, the stage never ran)')
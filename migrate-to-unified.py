@@ -0,0 +1,92 @@
+# This script is called as: python3 migrate-to-unified.py path/to/sqlite-database.db
+# It moves the db from the original layout (account+'Trans' and account+'Meta' tables for every account) to the unified one (a single
+# Transactions table, with account+'Trans' and account+'Meta' left as views of it). See moneydb.py for what the two layouts look like
+# ofx-to-sqlite.py, autocategorize.py and sqlite-to-gsheets.py work the same with either layout, so migrating is optional
+# Everything happens in one transaction, so if anything goes wrong the db is left as it was. Before that, a copy of the db is saved
+# as path/to/sqlite-database.db.bak (unless --no-backup)
+
+import argparse
+import sqlite3
+import os
+
+import moneydb
+
+def parseargs():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('sqlitedbfile', help="SQLite database to migrate. Expected to have extention .db")
+	parser.add_argument('--no-backup', action='store_true', help="Do not save a copy of the db as sqlitedbfile.bak before migrating")
+	args = parser.parse_args()
+	return (args.sqlitedbfile, args.no_backup)
+
+def backup_db(dbconn, backupfilename):
+	# sqlite's online backup, so the copy is consistent even if something else has the db open
+	backupconn = sqlite3.connect(backupfilename)
+	dbconn.backup(backupconn)
+	backupconn.close()
+
+def migrate_account(dbconn, account):
+	# Copies account's rows into Transactions, replaces account+'Trans' and account+'Meta' with views, and returns the number of rows copied
+	# account+'Meta' has no key, so in case a TransactionId is in it more than once, the earliest DBTimestamp wins and it counts as
+	# uploaded if any of its rows say so. A transaction with no Meta row at all gets no DBTimestamp and counts as not uploaded
+	accountTrans = account+'Trans'
+	accountMeta = account+'Meta'
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT "TransactionId", "DatePosted" FROM '''+accountTrans+''' WHERE date("DatePosted") IS NULL''')
+	badDates = dbcursor.fetchall()
+	if len(badDates) > 0:
+		for (transactionId, datePosted) in badDates[:10]:
+			print(f'{accountTrans}: Transaction {transactionId} has DatePosted {datePosted!r}, which is not a YYYY-MM-DD date.')
+		raise ValueError(f'{len(badDates)} transactions in {accountTrans} have an invalid DatePosted. Fix them and try again')
+	if moneydb.is_table(dbconn, accountMeta):
+		meta = '''(SELECT "TransactionId", MIN("DBTimestamp") AS "DBTimestamp", MAX("IsInGSheets") AS "IsInGSheets" FROM '''+accountMeta+''' GROUP BY "TransactionId")'''
+	else:
+		meta = '''(SELECT NULL AS "TransactionId", NULL AS "DBTimestamp", NULL AS "IsInGSheets")'''
+	dbcursor.execute('''INSERT INTO Transactions("Account", "TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes", "DBTimestamp", "IsInGSheets")
+		SELECT ?, T."TransactionId", date(T."DatePosted"), T."Payee", T."Amount", T."Memo", COALESCE(T."Category", 'Unknown'), T."Notes", M."DBTimestamp", COALESCE(M."IsInGSheets", 0)
+		FROM '''+accountTrans+''' AS T LEFT JOIN '''+meta+''' AS M ON M."TransactionId" = T."TransactionId"''', (account,))
+	nRows = dbcursor.rowcount
+	dbcursor.execute('''DROP TABLE IF EXISTS '''+accountMeta)
+	dbcursor.execute('''DROP TABLE '''+accountTrans)
+	moneydb.create_account_views(dbconn, account)
+	return nRows
+
+def migrate(dbconn):
+	# Returns a list of (account, number of transactions moved)
+	# An explicit write transaction, since sqlite3 would otherwise run the CREATEs and DROPs outside of any transaction
+	with moneydb.write_transaction(dbconn):
+		moneydb.create_unified_tables(dbconn)
+		accountTotals = []
+		for account in moneydb.valid_accounts:
+			if not moneydb.is_table(dbconn, account+'Trans'):
+				print(f'There is no {account}Trans table. Creating empty views for {account}.')
+				moneydb.create_account_views(dbconn, account)
+				accountTotals.append((account, 0))
+				continue
+			accountTotals.append((account, migrate_account(dbconn, account)))
+		moneydb.create_uncategorized_view(dbconn)
+		if moneydb.has_monthly_summary(dbconn):
+			# Its triggers went with the account+'Trans' tables. Its rows are still right, the same transactions are in Transactions now
+			moneydb.create_monthly_summary_triggers(dbconn)
+	dbconn.execute('''ANALYZE''') # So the query planner knows how selective the new indexes are
+	return accountTotals
+
+def main():
+	(sqlitedbfilename, nobackup) = parseargs()
+	if not os.path.exists(sqlitedbfilename):
+		print(f'{sqlitedbfilename} does not exist. Stopping..')
+		quit()
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	if moneydb.is_unified(dbconn):
+		print(f'{sqlitedbfilename} already has the unified layout. Nothing to do.')
+		quit()
+	if not nobackup:
+		backup_db(dbconn, sqlitedbfilename+'.bak')
+		print(f'Saved a copy of the db as {sqlitedbfilename}.bak')
+	accountTotals = migrate(dbconn)
+	dbconn.close()
+	for (account, nRows) in accountTotals:
+		print(f'{account}: {nRows} transactions moved to Transactions')
+	print(f'Migrated {sum(nRows for (account, nRows) in accountTotals)} transactions.')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# Things about the sqlite database that all of the scripts need: which accounts there are, how to open the db, how to write to it,
+# and the optional unified schema
+# This is not a script, the other scripts import it. Keep it next to them
+
+import sqlite3
+import contextlib
+import importlib.util
+import os
+
+import metrics
+
+# There are two layouts of the database
+# 1. The original one in sqlite-database.db: for each account, a table account+'Trans' with the transactions and a table account+'Meta'
+#    with when each was added to the db and whether it is in Google Sheets
+# 2. The unified one that migrate-to-unified.py turns it into: a single Transactions table for all accounts, with an Account column,
+#    DatePosted as a real (checked) date, and indexes on (Account, DatePosted), Category and IsInGSheets. account+'Trans' and
+#    account+'Meta' still exist, as views of the account's rows in Transactions. Their INSTEAD OF triggers turn INSERTs, UPDATEs and
+#    DELETEs on them into the same on Transactions. That way every script runs unchanged against either layout, while queries across
+#    accounts (like the Uncategorized view) can go straight to Transactions and its indexes
+
+# Connections are opened in WAL mode, which lets any number of readers go on while one connection writes. So a categorize session,
+# an export and an import can all have the db open at once. Writers still go one at a time, which is why writes should be short
+# transactions started with BEGIN IMMEDIATE (see write_transaction()): a write transaction that starts out deferred and only later
+# asks for the write lock fails straight away with "database is locked" if another connection wrote in between, instead of waiting
+# The rest of the pragmas trade a little durability on power loss (synchronous=NORMAL, which is still safe in WAL mode) and some
+# memory for speed
+busyTimeout = 60 # Seconds a connection waits for another one's write to finish before giving up with "database is locked"
+pragmas = [
+	'PRAGMA journal_mode = WAL',
+	'PRAGMA synchronous = NORMAL',
+	'PRAGMA cache_size = -65536', # In KiB when negative, so 64MB of page cache
+	'PRAGMA mmap_size = 268435456', # Read the first 256MB of the db through memory mapping instead of read() calls
+	'PRAGMA temp_store = MEMORY', # Temp tables (like ofx-to-sqlite.py's StagedTrans) and sorting never touch the disk
+]
+cachedStatements = 512 # Prepared statements kept per connection. The default of 128 is not enough for every statement for six accounts
+
+valid_accounts = ['AmexBlueCash', 'ChaseSapphireReserve', 'TechCUChecking', 'TechCUSavings', 'BofAChecking', 'BofASavings']
+
+def verify_account(account):
+	if account in valid_accounts:
+		return True
+	else:
+		return False
+
+def load_script(filename):
+	# Imports one of the scripts next to this file, e.g. load_script('ofx-to-sqlite.py'), for the scripts that build on the others
+	# The scripts have hyphens in their names, so they cannot be imported with import
+	spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].replace('-', '_'), os.path.join(os.path.dirname(os.path.abspath(__file__)), filename))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+# TODO: Add error checking to this function
+def open_sqlite_db(sqlitedbfilename):
+	# TODO: Verify sqlitedbfilename exists?
+	# With --metrics, the connection times every query (see metrics.TimedConnection)
+	dbconn = sqlite3.connect(sqlitedbfilename, timeout=busyTimeout, cached_statements=cachedStatements, factory=metrics.connection_factory())
+	for pragma in pragmas:
+		dbconn.execute(pragma)
+	return dbconn
+
+def account_sql(template, account):
+	# The SQL for one account from a template with {Trans}, {Meta} and {Lookup} in place of the names of account's tables, and
+	# {Account} in place of the account name. The same template and account always give back the same string, so with
+	# cachedStatements, sqlite3 prepares each statement once per account and connection, not per use
+	return template.format(Trans=account+'Trans', Meta=account+'Meta', Lookup=account+'Lookup', Account=account)
+
+def begin_write(dbconn):
+	# Starts a write transaction on dbconn, taking the write lock right away (waiting for up to busyTimeout if another connection
+	# has it), unless dbconn is in a transaction already. Commit it with dbconn.commit() as usual
+	if not dbconn.in_transaction:
+		dbconn.execute('''BEGIN IMMEDIATE''')
+
+@contextlib.contextmanager
+def write_transaction(dbconn):
+	# with write_transaction(dbconn): runs the block as one write transaction, see begin_write(). Commits at the end of the block,
+	# or rolls back if it raises. If dbconn was already in a transaction, that one is left for its owner to commit
+	owner = not dbconn.in_transaction
+	begin_write(dbconn)
+	try:
+		yield dbconn
+	except:
+		if owner:
+			dbconn.rollback()
+		raise
+	if owner:
+		dbconn.commit()
+
+def is_unified(dbconn):
+	# True if the db has the unified layout, i.e. it has a Transactions table
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'Transactions' ''')
+	return dbcursor.fetchone()[0] > 0
+
+def is_table(dbconn, name):
+	# True if name is a table, as opposed to a view (like account+'Trans' in the unified layout) or nothing at all
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?''', (name,))
+	return dbcursor.fetchone()[0] > 0
+
+def create_unified_tables(dbconn):
+	# Creates the Transactions table and its indexes. Does not commit
+	# DatePosted must be a YYYY-MM-DD date. sqlite has no date type, so the CHECK is what keeps it one
+	# DBTimestamp and IsInGSheets are what used to be in account+'Meta'
+	dbconn.execute('''CREATE TABLE IF NOT EXISTS Transactions ("Account" TEXT NOT NULL, "TransactionId" TEXT NOT NULL, "DatePosted" DATE NOT NULL CHECK ("DatePosted" IS date("DatePosted")), "Payee" TEXT NOT NULL, "Amount" REAL NOT NULL, "Memo" TEXT, "Category" TEXT REFERENCES Categories ("Category") DEFAULT 'Unknown', "Notes" TEXT, "DBTimestamp" TEXT, "IsInGSheets" INTEGER NOT NULL DEFAULT 0, PRIMARY KEY ("Account", "TransactionId"))''')
+	dbconn.execute('''CREATE INDEX IF NOT EXISTS TransactionsAccountDatePosted ON Transactions("Account", "DatePosted")''')
+	dbconn.execute('''CREATE INDEX IF NOT EXISTS TransactionsCategory ON Transactions("Category")''')
+	dbconn.execute('''CREATE INDEX IF NOT EXISTS TransactionsIsInGSheets ON Transactions("IsInGSheets", "Account")''')
+
+def create_account_views(dbconn, account):
+	# Creates the account+'Trans' and account+'Meta' views of account's rows in Transactions, and the triggers that make them
+	# writable. Their columns are the same as those of the original tables. Does not commit
+	# Views have no column defaults, so the insert trigger fills in the defaults the original account+'Trans' had
+	accountTrans = account+'Trans'
+	accountMeta = account+'Meta'
+	where = '''"Account" = \''''+account+'''\' '''
+	dbconn.execute('''CREATE VIEW '''+accountTrans+''' AS SELECT "TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes" FROM Transactions WHERE '''+where)
+	dbconn.execute('''CREATE VIEW '''+accountMeta+''' AS SELECT "TransactionId", "DBTimestamp", "IsInGSheets" FROM Transactions WHERE '''+where)
+	dbconn.execute('''CREATE TRIGGER '''+accountTrans+'''Insert INSTEAD OF INSERT ON '''+accountTrans+''' BEGIN
+		INSERT INTO Transactions("Account", "TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes") VALUES (\''''+account+'''\', NEW."TransactionId", date(NEW."DatePosted"), NEW."Payee", NEW."Amount", NEW."Memo", COALESCE(NEW."Category", 'Unknown'), NEW."Notes");
+		END''')
+	dbconn.execute('''CREATE TRIGGER '''+accountTrans+'''Update INSTEAD OF UPDATE ON '''+accountTrans+''' BEGIN
+		UPDATE Transactions SET "TransactionId" = NEW."TransactionId", "DatePosted" = date(NEW."DatePosted"), "Payee" = NEW."Payee", "Amount" = NEW."Amount", "Memo" = NEW."Memo", "Category" = NEW."Category", "Notes" = NEW."Notes" WHERE '''+where+''' AND "TransactionId" = OLD."TransactionId";
+		END''')
+	dbconn.execute('''CREATE TRIGGER '''+accountTrans+'''Delete INSTEAD OF DELETE ON '''+accountTrans+''' BEGIN
+		DELETE FROM Transactions WHERE '''+where+''' AND "TransactionId" = OLD."TransactionId";
+		END''')
+	# A row of account+'Meta' is always added right after its row of account+'Trans' (see ofx-to-sqlite.py), so inserting one just
+	# fills in the Meta columns of the row that is already there
+	dbconn.execute('''CREATE TRIGGER '''+accountMeta+'''Insert INSTEAD OF INSERT ON '''+accountMeta+''' BEGIN
+		UPDATE Transactions SET "DBTimestamp" = NEW."DBTimestamp", "IsInGSheets" = COALESCE(NEW."IsInGSheets", 0) WHERE '''+where+''' AND "TransactionId" = NEW."TransactionId";
+		END''')
+	dbconn.execute('''CREATE TRIGGER '''+accountMeta+'''Update INSTEAD OF UPDATE ON '''+accountMeta+''' BEGIN
+		UPDATE Transactions SET "DBTimestamp" = NEW."DBTimestamp", "IsInGSheets" = NEW."IsInGSheets" WHERE '''+where+''' AND "TransactionId" = OLD."TransactionId";
+		END''')
+
+def create_uncategorized_view(dbconn):
+	# The Uncategorized view of the unified layout. Same columns as the original one, which is a UNION of all the account+'Trans'
+	# tables, but it is a single query on Transactions that can use its Category index. Does not commit
+	dbconn.execute('''DROP VIEW IF EXISTS Uncategorized''')
+	dbconn.execute('''CREATE VIEW Uncategorized AS SELECT "TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes" FROM Transactions WHERE "Category" = 'Unknown' ORDER BY "DatePosted" DESC''')
+
+# The MonthlySummary table has the total and number of transactions for every month, account and category. Reports and dashboards
+# that only need those can read it instead of every transaction of every account (see monthly-summary.py)
+# It is kept up to date by triggers, so every way a transaction gets added, recategorized, edited or deleted (ofx-to-sqlite.py,
+# autocategorize.py, watch-inbox.py, or by hand in sqlitestudio) is counted, without any of the scripts having to know about it
+# In the original layout the triggers are on each account+'Trans' table. In the unified layout they are on Transactions, which is
+# where the INSTEAD OF triggers of the account+'Trans' views write to
+# Month is the first day of the month, like TransactionMonth in Google Sheets (see sqlite-to-gsheets.py)
+monthlySummaryMonth = '''COALESCE(date({Row}."DatePosted", 'start of month'), {Row}."DatePosted")''' # A DatePosted that is not a date is kept as it is
+monthlySummaryAdd = '''INSERT INTO MonthlySummary("Month", "Account", "Category", "Total", "Count") VALUES ('''+monthlySummaryMonth.format(Row='NEW')+''', {AccountValue}, COALESCE(NEW."Category", 'Unknown'), NEW."Amount", 1)
+		ON CONFLICT("Month", "Account", "Category") DO UPDATE SET "Total" = "Total" + excluded."Total", "Count" = "Count" + 1;'''
+monthlySummaryRemove = '''UPDATE MonthlySummary SET "Total" = "Total" - OLD."Amount", "Count" = "Count" - 1 WHERE "Month" = '''+monthlySummaryMonth.format(Row='OLD')+''' AND "Account" = {AccountValueOld} AND "Category" = COALESCE(OLD."Category", 'Unknown');
+		DELETE FROM MonthlySummary WHERE "Month" = '''+monthlySummaryMonth.format(Row='OLD')+''' AND "Account" = {AccountValueOld} AND "Category" = COALESCE(OLD."Category", 'Unknown') AND "Count" < 1;'''
+
+def has_monthly_summary(dbconn):
+	return is_table(dbconn, 'MonthlySummary')
+
+def create_monthly_summary(dbconn):
+	# Creates the MonthlySummary table and its triggers, and fills it in from the transactions already in the db. Does not commit
+	dbconn.execute('''CREATE TABLE IF NOT EXISTS MonthlySummary ("Month" TEXT NOT NULL, "Account" TEXT NOT NULL, "Category" TEXT NOT NULL, "Total" REAL NOT NULL, "Count" INTEGER NOT NULL, PRIMARY KEY ("Month", "Account", "Category")) WITHOUT ROWID''')
+	create_monthly_summary_triggers(dbconn)
+	rebuild_monthly_summary(dbconn)
+
+def create_monthly_summary_triggers(dbconn):
+	# (Re)creates the triggers that keep MonthlySummary up to date, for whichever layout the db has. Does not commit
+	# UPDATEs only fire them if they set DatePosted, Amount or Category, so marking transactions as uploaded costs nothing extra
+	if is_unified(dbconn):
+		targets = [('Transactions', '''NEW."Account"''', '''OLD."Account"''', ''', "Account"''')]
+	else:
+		targets = [(account+'Trans', "'"+account+"'", "'"+account+"'", '') for account in valid_accounts if is_table(dbconn, account+'Trans')]
+	for (table, accountValue, accountValueOld, accountColumn) in targets:
+		add = monthlySummaryAdd.format(AccountValue=accountValue)
+		remove = monthlySummaryRemove.format(AccountValueOld=accountValueOld)
+		dbconn.execute('''DROP TRIGGER IF EXISTS '''+table+'''SummaryInsert''')
+		dbconn.execute('''DROP TRIGGER IF EXISTS '''+table+'''SummaryUpdate''')
+		dbconn.execute('''DROP TRIGGER IF EXISTS '''+table+'''SummaryDelete''')
+		dbconn.execute('''CREATE TRIGGER '''+table+'''SummaryInsert AFTER INSERT ON '''+table+''' BEGIN
+		'''+add+'''
+		END''')
+		dbconn.execute('''CREATE TRIGGER '''+table+'''SummaryUpdate AFTER UPDATE OF "DatePosted", "Amount", "Category"'''+accountColumn+''' ON '''+table+''' BEGIN
+		'''+remove+'''
+		'''+add+'''
+		END''')
+		dbconn.execute('''CREATE TRIGGER '''+table+'''SummaryDelete AFTER DELETE ON '''+table+''' BEGIN
+		'''+remove+'''
+		END''')
+
+def rebuild_monthly_summary(dbconn):
+	# Recomputes all of MonthlySummary from the transactions. Does not commit
+	# Totals kept up by the triggers can pick up rounding errors of a fraction of a cent over many updates. This gets rid of them
+	dbconn.execute('''DELETE FROM MonthlySummary''')
+	if is_unified(dbconn):
+		dbconn.execute('''INSERT INTO MonthlySummary("Month", "Account", "Category", "Total", "Count") SELECT '''+monthlySummaryMonth.format(Row='Transactions')+''', "Account", COALESCE("Category", 'Unknown'), SUM("Amount"), COUNT(*) FROM Transactions GROUP BY 1, 2, 3''')
+		return
+	for account in valid_accounts:
+		if not is_table(dbconn, account+'Trans'):
+			continue
+		dbconn.execute(account_sql('''INSERT INTO MonthlySummary("Month", "Account", "Category", "Total", "Count") SELECT '''+monthlySummaryMonth.format(Row='{Trans}')+''', '{Account}', COALESCE("Category", 'Unknown'), SUM("Amount"), COUNT(*) FROM {Trans} GROUP BY 1, 3''', account))
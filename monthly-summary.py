@@ -0,0 +1,130 @@
+# This script is called as: python3 monthly-summary.py path/to/sqlite-database.db [FinancialAccountName ...]
+# It prints the total and number of transactions of every month and category, for the given accounts (default is all of them), from
+# the MonthlySummary table (see moneydb.py) instead of from the transactions themselves. So it takes about as long for ten years of
+# transactions as for one month
+# The first run creates MonthlySummary and fills it in from the transactions already in the db. After that, triggers keep it up to
+# date as transactions are added and categorized. --rebuild fills it in from scratch again
+# With --csv FILE the same rows are written to FILE. With --upload they replace the contents of the 'MonthlySummary' tab of the
+# Google Spreadsheet sqlite-to-gsheets.py uploads to, so dashboards can be built on a few hundred summary rows instead of on every
+# transaction. That tab has to exist. Like sqlite-to-gsheets.py, --local-sheet writes to a local csv file instead, for testing offline
+
+import argparse
+import csv
+import os
+
+import moneydb
+import metrics
+
+def parseargs():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('sqlitedbfile', help="SQLite database. Expected to have extention .db")
+	parser.add_argument('accounts', nargs='*', help="Accounts to summarize. Default is all of them")
+	parser.add_argument('-f', '--from', dest='frommonth', default=None, help="First month to summarize, as YYYY-MM. Default is the first one there is")
+	parser.add_argument('-t', '--to', dest='tomonth', default=None, help="Last month to summarize, as YYYY-MM. Default is the last one there is")
+	parser.add_argument('-a', '--by-account', action='store_true', help="Keep the accounts apart instead of adding them up")
+	parser.add_argument('--rebuild', action='store_true', help="Fill in MonthlySummary from the transactions again before summarizing")
+	parser.add_argument('--csv', default=None, help="Also write the summary rows to this csv file")
+	parser.add_argument('-u', '--upload', action='store_true', help="Replace the contents of the MonthlySummary tab of the Google Spreadsheet with the summary rows")
+	parser.add_argument('--local-sheet', default=None, help="With --upload, write to this csv file instead of Google Sheets, for testing offline")
+	metrics.add_arguments(parser)
+	args = parser.parse_args()
+	return (args.sqlitedbfile, args.accounts or moneydb.valid_accounts, args.frommonth, args.tomonth, args.by_account, args.rebuild, args.csv, args.upload, args.local_sheet, args.metrics, args.profile)
+
+def ensure_monthly_summary(dbconn, rebuild=False):
+	# Creates and fills in MonthlySummary if the db does not have it yet, or fills it in again if rebuild is set
+	if moneydb.has_monthly_summary(dbconn) and not rebuild:
+		return
+	print('Summarizing all transactions into MonthlySummary. This only has to be done once.' if not rebuild else 'Rebuilding MonthlySummary from all transactions.')
+	with moneydb.write_transaction(dbconn):
+		if moneydb.has_monthly_summary(dbconn):
+			moneydb.rebuild_monthly_summary(dbconn)
+		else:
+			moneydb.create_monthly_summary(dbconn)
+	dbconn.execute('''ANALYZE MonthlySummary''')
+
+def get_summary_rows(dbconn, accounts, frommonth, tomonth, byaccount):
+	# Returns a list of Month,Category,Total,Count rows (Month,Account,Category,Total,Count with byaccount), ordered by month
+	# frommonth and tomonth are YYYY-MM, or None for no limit
+	columns = '''"Month", "Account", "Category"''' if byaccount else '''"Month", "Category"'''
+	dbcursor = dbconn.cursor()
+	dbcursor.execute('''SELECT '''+columns+''', ROUND(SUM("Total"), 2), SUM("Count") FROM MonthlySummary WHERE "Account" IN ('''+','.join('?' * len(accounts))+''') AND "Month" >= ? AND "Month" <= ? GROUP BY '''+columns+''' ORDER BY '''+columns,
+		list(accounts) + [frommonth+'-01' if frommonth else '', tomonth+'-01' if tomonth else '9999'])
+	return dbcursor.fetchall()
+
+def print_summary(rows, byaccount):
+	# One block per month, with the month's total at the end
+	month = None
+	monthTotal = 0
+	for row in rows:
+		if row[0] != month:
+			if month is not None:
+				print(f'{"":<4}{"Total":<40}{monthTotal:>12.2f}')
+			month = row[0]
+			monthTotal = 0
+			print(month[:7])
+		label = f'{row[2]} ({row[1]})' if byaccount else row[1]
+		print(f'{"":<4}{label:<40}{row[-2]:>12.2f}{row[-1]:>6} transactions')
+		monthTotal = monthTotal + row[-2]
+	if month is not None:
+		print(f'{"":<4}{"Total":<40}{monthTotal:>12.2f}')
+
+def upload_summary(sheet, header, rows, sqlitetogsheets, ratelimiter):
+	# Replaces whatever is in sheet with header and rows. Two requests however many rows there are, both retried like uploads of
+	# transactions (see sqlitetogsheets.send_with_retries()): one that writes the rows from A1 on, over what was there, and one
+	# that clears whatever is left of an earlier, bigger summary, below and to the right of them
+	# The sheet is never left empty: if the first request fails, the previous summary is left as it was. Returns True if both went through
+	values = [header] + [list(row) for row in rows]
+	response = sqlitetogsheets.send_with_retries(lambda: sheet.update(range_name='A1', values=values, value_input_option='USER_ENTERED'), f'{len(rows)} summary rows', ratelimiter)
+	if response is None:
+		return False
+	if response.get('updatedRows', 0) != len(values):
+		print(f'Sent {len(values)} rows but Google Sheets confirmed {response.get("updatedRows", 0)}.')
+		return False
+	nextColumn = chr(ord('A') + len(header))
+	leftovers = [f'A{len(values)+1}:Z', f'{nextColumn}1:Z{len(values)}']
+	if sqlitetogsheets.send_with_retries(lambda: sheet.batch_clear(leftovers), 'the request that clears the rest of the previous summary', ratelimiter) is None:
+		print('The new summary rows are there, but some of the previous summary may be left below them.')
+		return False
+	return True
+
+def main():
+	(sqlitedbfilename, accounts, frommonth, tomonth, byaccount, rebuild, csvfilename, upload, localsheetfilename, metricsfilename, profilestage) = parseargs()
+	metrics.enable('monthly-summary.py', metricsfilename, profilestage)
+	for account in accounts:
+		if moneydb.verify_account(account) == False:
+			print(f'Unknown account: {account}. Stopping..')
+			quit()
+	if not os.path.exists(sqlitedbfilename):
+		print(f'{sqlitedbfilename} does not exist. Stopping..')
+		quit()
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	ensure_monthly_summary(dbconn, rebuild)
+	with metrics.stage('summarize'):
+		rows = get_summary_rows(dbconn, accounts, frommonth, tomonth, byaccount)
+	dbconn.close()
+	if len(rows) < 1:
+		print('There are no transactions in that range.')
+		quit()
+	print_summary(rows, byaccount)
+	header = ['Month', 'Account', 'Category', 'Total', 'Count'] if byaccount else ['Month', 'Category', 'Total', 'Count']
+	if csvfilename:
+		with open(csvfilename, 'w', newline='') as csvfile:
+			csv.writer(csvfile).writerows([header] + rows)
+		print(f'Wrote {len(rows)} summary rows to {csvfilename}.')
+	if upload:
+		sqlitetogsheets = moneydb.load_script('sqlite-to-gsheets.py')
+		if localsheetfilename:
+			sheet = sqlitetogsheets.LocalSheet(localsheetfilename)
+		else:
+			# TODO: Error checking for below func
+			client = sqlitetogsheets.connect_to_google()
+			sheet = client.open("Finances").worksheet("MonthlySummary")
+		# The same quota as uploads of transactions, see sqlite-to-gsheets.py
+		ratelimiter = sqlitetogsheets.RateLimiter(sqlitetogsheets.defaultRequestsPerMinute, sqlitetogsheets.defaultBurst)
+		with metrics.stage('upload'):
+			uploaded = upload_summary(sheet, header, rows, sqlitetogsheets, ratelimiter)
+		if uploaded:
+			print(f'Uploaded {len(rows)} summary rows.')
+
+if __name__ == "__main__":
+    main()
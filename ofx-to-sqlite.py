@@ -1,21 +1,56 @@
-# This script is called like: python3 ofx-to-sqlite.py foo.ofx path/to/sqlite-database.db
+# This script is called like: python3 ofx-to-sqlite.py foo.ofx [bar.qfx path/to/statements/ 'path/*.ofx' ...] path/to/sqlite-database.db
 # foo.ofx is the file downloaded by ofxtools (or manually) from the institution's website
+# Any number of files, directories (all .ofx/.qfx files in them) or glob patterns can be given. They are parsed in parallel
+# by a pool of worker processes (see -j) and all of them are written to the db through a single connection
+# With --stream, files are not parsed into a full document tree by ofxparse. Instead their transactions are read one at a time
+# and written to the db in batches of --batch-size, so memory use stays flat no matter how large the statement is
 # sqlite-database.db is a sqlite database file with a particular structure.
 # Open up the provided sqlite.db file in e.g. sqlitestudio to explore it
+# With --metrics FILE, the time spent parsing, deduping, inserting and committing, and the db queries, are appended to FILE (see metrics.py)
 
 import argparse
 from ofxparse import OfxParser
 import codecs
 import datetime
 import dateutil.parser as dparser
+import os
+import glob
+import re
+import html
+import decimal
+import itertools
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import moneydb
+import metrics
 
 def parseargs():
 	parser = argparse.ArgumentParser()
-	parser.add_argument('ofxfile', help="Input OFX/QFX file. Expected to have extension .ofx or .qfx")
+	parser.add_argument('ofxfiles', nargs='+', help="Input OFX/QFX files, directories containing them, or glob patterns. Files are expected to have extension .ofx or .qfx")
 	parser.add_argument('sqlitedbfile', help="SQLite database. Expected to have extention .db")
+	parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="Number of worker processes used to parse the OFX/QFX files. Default is the number of cores")
+	parser.add_argument('-s', '--stream', action='store_true', help="Read transactions incrementally instead of parsing the whole file up front. Use for very large statements. Files are then read one after the other")
+	parser.add_argument('-b', '--batch-size', type=int, default=1000, help="Number of transactions written to the db per batch. Default is 1000")
+	metrics.add_arguments(parser)
 	args = parser.parse_args()	
-	return(args.ofxfile,args.sqlitedbfile)
+	return(args.ofxfiles,args.sqlitedbfile,args.jobs,args.stream,args.batch_size,args.metrics,args.profile)
+
+def expand_ofx_paths(paths):
+	# Each path can be a file, a directory (all .ofx/.qfx files in it) or a glob pattern like 'statements/*.qfx'
+	# Returns the list of files in the order given, without duplicates
+	ofxfilenames = []
+	for path in paths:
+		if os.path.isdir(path):
+			matches = sorted(os.path.join(path, name) for name in os.listdir(path) if os.path.splitext(name)[1].lower() in ('.ofx', '.qfx'))
+		elif glob.has_magic(path):
+			matches = sorted(glob.glob(path))
+		else:
+			matches = [path]
+		for match in matches:
+			if match not in ofxfilenames:
+				ofxfilenames.append(match)
+	return ofxfilenames
 
 # TODO: Add error checking to this function
 def open_ofx_file(ofxfilename):
@@ -24,31 +59,27 @@ def open_ofx_file(ofxfilename):
 		# TODO: Verify above function executed successfully?
 		return ofx
 
-# TODO: Add error checking to this function
-def open_sqlite_db(sqlitedbfilename):
-	# TODO: Verify sqlitedbfilename exists?
-	dbconn = sqlite3.connect(sqlitedbfilename)
-	# TODO: Verify connect is successful?
-	return dbconn
-
 def determine_account_name(ofx):
 	# TODO: Ensure ofx is a valid object
+	return account_name_for(ofx.account.institution.organization, ofx.account.account_type)
+
+def account_name_for(organization, accountType):
 	# NOTE: Open the OFX file in a text editor to understand the strings used for account.institution.organization. These are just examples from the few ofx files I got my hands on
+	# organization is the <ORG> of the institution and accountType the <ACCTTYPE> of the account (if any)
 	accountName = 'Unknown'
-	account = ofx.account
-	if account.institution.organization == 'AMEX':
+	if organization == 'AMEX':
 		accountName = 'AmexBlueCash'
-	elif account.institution.organization == 'B1':
+	elif organization == 'B1':
 		accountName = 'ChaseSapphireReserve'
-	elif account.institution.organization == 'Tech CU' or account.institution.organization == 'TECHCUDC':
-		if account.account_type == 'CHECKING':
+	elif organization == 'Tech CU' or organization == 'TECHCUDC':
+		if accountType == 'CHECKING':
 			accountName = 'TechCUChecking'
-		elif account.account_type == 'SAVINGS':
+		elif accountType == 'SAVINGS':
 			accountName = 'TechCUSavings'
-	elif account.institution.organization == 'Bank of America':
-		if account.account_type == 'CHECKING':
+	elif organization == 'Bank of America':
+		if accountType == 'CHECKING':
 			accountName = 'BofAChecking'
-		elif account.account_type == 'MONEYMRKT':
+		elif accountType == 'MONEYMRKT':
 			accountName = 'BofASavings'
 	return accountName
 
@@ -62,66 +93,334 @@ def get_transactions(ofx):
 	transactions.reverse()
 	return transactions
 
-def write_transactions_to_db(transactions, dbconn, account):
-	# TODO: ensure all args have valid content, esp. transactions has at least one entry
-	dbcursor = dbconn.cursor()
-	accountTrans = account+'Trans' # The transactions table for the account
-	accountMeta = account+'Meta' # The meta table for the account
-	writeCount = 0
-	for transaction in transactions:
-		# We will only add a transaction if it does not exist in db
-		# Existence is determined as: If transid exists within +/- 5 days of trans date
-		# Probably not needed, since transaction id is defined as unique in database table
-		# accountTrans cols are: TransactionId, DatePosted, Payee, Amount, Memo, Category, Notes
-		# accountMeta cols are: TransactionId, DBTimestamp, IsInGSheets
-		dateUpper = transaction.date + datetime.timedelta(days=+5)
-		dateLower = transaction.date - datetime.timedelta(days=+5)
-		dbcursor.execute('''SELECT * FROM '''+accountTrans+''' WHERE date(DatePosted) BETWEEN ? AND ?''', (dateLower.strftime('%Y-%m-%d'), dateUpper.strftime('%Y-%m-%d')))
-		exists = 0 # Does transaction exist? Default is no
-		for dbrow in dbcursor:
-			if dbrow[0] == transaction.id:
-				#print (f"Row with transaction id {transaction.id} already exists. Skipping..")
-				#print (dbrow)
-				exists = 1
-				break
-		if exists == 0:
-			# First add the transaction data. Category should be Unknown and Notes should be blank
-			dbcursor.execute('''INSERT INTO '''+accountTrans+'''("TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes") VALUES (?,?,?,?,?,?,?)''', (transaction.id, transaction.date.strftime("%Y-%m-%d"), transaction.payee, str(transaction.amount), transaction.memo, "Unknown", ""))
-			# Then the transaction metadata. IsInGSheets should be 0
-			dbcursor.execute('''INSERT INTO '''+accountMeta+'''("TransactionId", "DBTimestamp", "IsInGSheets") VALUES (?, ?, ?)''', (transaction.id, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), 0))
-			writeCount = writeCount +1
-	dbconn.commit()
-	return writeCount
+# Streaming reader. OFX files are SGML (leaf tags usually have no closing tag) or XML, so rather than building a
+# document tree we just scan for tags and the text that follows each one, and collect the fields of each <STMTTRN>
+# Only bank and credit card statements (<STMTTRN>) are handled. Investment statements use different records
+ofxTagPattern = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+def iter_ofx_tags(fileobj, chunksize=65536):
+	# Yields (isClosingTag, TAGNAME, text after the tag) for every tag in fileobj, reading chunksize characters at a time
+	buffer = ''
+	while True:
+		chunk = fileobj.read(chunksize)
+		if not chunk:
+			break
+		buffer = buffer + chunk
+		# The last tag in the buffer may be cut off or its text may continue in the next chunk, so keep it for the next round
+		last = buffer.rfind('<')
+		if last < 1:
+			continue
+		for match in ofxTagPattern.finditer(buffer, 0, last):
+			yield (match.group(1) == '/', match.group(2).upper(), html.unescape(match.group(3).strip()))
+		buffer = buffer[last:]
+	for match in ofxTagPattern.finditer(buffer):
+		yield (match.group(1) == '/', match.group(2).upper(), html.unescape(match.group(3).strip()))
+
+def ofx_amount(amount):
+	# Same number formats as ofxparse's OfxParser.toDecimal. Returns the amount as a string, like str(transaction.amount)
+	if re.search(r'.*\..*,', amount): # 10,000.50
+		amount = amount.replace('.', '')
+	if re.search(r'.*,.*\.', amount): # 10.000,50
+		amount = amount.replace(',', '')
+	if '.' not in amount and ',' in amount: # 10000,50
+		amount = amount.replace(',', '.')
+	amount = amount.replace(' ', '').replace('+', '') # 1 025,53 and +1058,53
+	if amount in ('null', '-null'): # Some banks use a null transaction for interest rate changes
+		return '0'
+	return str(decimal.Decimal(amount))
+
+def ofx_date(ofxDateTime):
+	# Same as ofxparse's OfxParser.parseOfxDateTime, so streamed and parsed files agree on the date
+	# e.g. 20101106160000.00[-5:EST] is 6 Nov 2010 4pm UTC-5. Like ofxparse, the date is shifted to UTC
+	timezone = re.search(r"\[(?P<tz>[-+]?\d+\.?\d*)\:\w*\]$", ofxDateTime)
+	timezoneOffset = datetime.timedelta(hours=float(timezone.group('tz')) if timezone else 0)
+	fraction = re.search(r"^[0-9]*\.([0-9]{0,5})", ofxDateTime)
+	seconds = datetime.timedelta(seconds=float("0." + fraction.group(1)) if fraction else 0)
+	try:
+		localDate = datetime.datetime.strptime(ofxDateTime[:14], '%Y%m%d%H%M%S')
+	except ValueError:
+		localDate = datetime.datetime.strptime(ofxDateTime[:8], '%Y%m%d')
+	return (localDate - timezoneOffset + seconds).strftime('%Y-%m-%d')
+
+def open_ofx_stream(ofxfilename):
+	# Reads the file only up to its first transaction and returns (organization, accountType, statementInfo, rows)
+	# rows is a generator of (TransactionId, DatePosted, Payee, Amount, Memo) rows, like transaction_to_row() makes, in file order
+	# statementInfo is a dict that rows fills in with balance, balanceAsOf, start and end as it comes across them
+	# Balance usually comes after the transactions, so statementInfo is only complete once rows is exhausted
+	# TODO: Add error checking to this function
+	fileobj = open(ofxfilename, errors='replace')
+	statementInfo = {'balance': None, 'balanceAsOf': None, 'start': None, 'end': None}
+	(organization, accountType, tags) = read_ofx_header(iter_ofx_tags(fileobj), statementInfo)
+	return (organization, accountType, statementInfo, iter_ofx_rows(fileobj, tags, statementInfo))
+
+def read_ofx_header(tags, statementInfo):
+	# Consumes tags up to the first <STMTTRN>. Returns (organization, accountType, the rest of the tags starting at that <STMTTRN>)
+	organization = None
+	accountType = '' # Credit card accounts have no <ACCTTYPE>. ofxparse leaves account_type blank for them too
+	for (isClosingTag, tag, text) in tags:
+		if tag == 'STMTTRN' and not isClosingTag:
+			return (organization, accountType, itertools.chain([(isClosingTag, tag, text)], tags))
+		elif tag == 'ORG' and organization is None:
+			organization = text
+		elif tag == 'ACCTTYPE' and not accountType:
+			accountType = text
+		else:
+			update_statement_info(statementInfo, tag, text)
+	return (organization, accountType, tags)
+
+def update_statement_info(statementInfo, tag, text):
+	if tag == 'DTSTART':
+		statementInfo['start'] = ofx_date(text)
+	elif tag == 'DTEND':
+		statementInfo['end'] = ofx_date(text)
+	elif tag == 'BALAMT' and statementInfo['balance'] is None: # LEDGERBAL comes before AVAILBAL
+		statementInfo['balance'] = decimal.Decimal(text)
+	elif tag == 'DTASOF' and statementInfo['balanceAsOf'] is None:
+		statementInfo['balanceAsOf'] = ofx_date(text)
+
+def iter_ofx_rows(fileobj, tags, statementInfo):
+	# Only one transaction's fields are held in memory at a time
+	try:
+		fields = None
+		for (isClosingTag, tag, text) in tags:
+			if tag == 'STMTTRN':
+				if not isClosingTag:
+					fields = {}
+				elif fields is not None:
+					yield (fields.get('FITID'), ofx_date(fields['DTPOSTED']), fields.get('NAME', ''), ofx_amount(fields['TRNAMT']), fields.get('MEMO', ''))
+					fields = None
+			elif fields is not None:
+				if not isClosingTag and tag not in fields: # First one wins, like ofxparse's find()
+					fields[tag] = text
+			else:
+				update_statement_info(statementInfo, tag, text)
+	finally:
+		fileobj.close()
 
-def print_ofx_data(ofx):
+def get_ofx_summary(ofx):
 	# TODO: Ensure ofx is valid object
-	# Print ofx stats: accountBalance + asOf, stmtStart, stmtEnd
+	# ofx stats: accountBalance + asOf, stmtStart, stmtEnd
 	accountBalance = ofx.account.statement.balance
 	balanceAsOf = ofx.account.statement.balance_date.strftime('%Y-%m-%d')
 	stmtStartDate = ofx.account.statement.start_date.strftime('%Y-%m-%d')
 	stmtEndDate = ofx.account.statement.end_date.strftime('%Y-%m-%d')
+	return (accountBalance, balanceAsOf, stmtStartDate, stmtEndDate)
+
+def transaction_to_row(transaction):
+	# Maps an ofxparse Transaction to the accountTrans cols: TransactionId, DatePosted, Payee, Amount, Memo
+	# Category and Notes are not part of the row since every new transaction starts as Unknown with blank Notes
+	return (transaction.id, transaction.date.strftime("%Y-%m-%d"), transaction.payee, str(transaction.amount), transaction.memo)
+
+def ensure_meta_index(dbconn, account):
+	# accountMeta has no key of its own, so give it a unique index on TransactionId
+	# This keeps the Meta insert below from ever duplicating a row and lets lookups by TransactionId use the index
+	# In the unified layout (see moneydb.py) accountMeta is a view of Transactions, which is already keyed by TransactionId
+	# If accountMeta already has a TransactionId more than once (e.g. from imports before it had the index), the index cannot be
+	# created until those rows are merged. Like migrate-to-unified.py does, the earliest DBTimestamp wins and it counts as uploaded
+	# if any of its rows say so
+	accountMeta = account+'Meta'
+	if not moneydb.is_table(dbconn, accountMeta):
+		return
+	createIndex = '''CREATE UNIQUE INDEX IF NOT EXISTS "'''+accountMeta+'''TransactionId" ON '''+accountMeta+'''("TransactionId")'''
+	try:
+		dbconn.execute(createIndex)
+	except sqlite3.IntegrityError:
+		with moneydb.write_transaction(dbconn):
+			nDuplicates = merge_duplicate_meta_rows(dbconn, accountMeta)
+			dbconn.execute(createIndex)
+		print(f'{accountMeta}: Merged {nDuplicates} duplicate rows, so that each transaction has one.')
+
+def merge_duplicate_meta_rows(dbconn, accountMeta):
+	# Leaves one row per TransactionId in accountMeta, see ensure_meta_index(). Returns the number of rows deleted. Does not commit
+	dbconn.execute('''UPDATE '''+accountMeta+''' AS M SET "DBTimestamp" = D."DBTimestamp", "IsInGSheets" = D."IsInGSheets"
+		FROM (SELECT "TransactionId", MIN("DBTimestamp") AS "DBTimestamp", MAX("IsInGSheets") AS "IsInGSheets" FROM '''+accountMeta+''' GROUP BY "TransactionId" HAVING COUNT(*) > 1) AS D
+		WHERE M."TransactionId" = D."TransactionId"''')
+	return dbconn.execute('''DELETE FROM '''+accountMeta+''' WHERE rowid NOT IN (SELECT MIN(rowid) FROM '''+accountMeta+''' GROUP BY "TransactionId")''').rowcount
+
+def write_transactions_to_db(transactions, dbconn, account, commit=True, batchsize=1000):
+	# TODO: ensure all args have valid content, esp. transactions has at least one entry
+	# transactions is an iterable (list or generator) of (TransactionId, DatePosted, Payee, Amount, Memo) rows, see transaction_to_row()
+	# Returns (number of transactions written, number skipped as already in db)
+	# With commit=False the caller decides when to commit, e.g. to make it part of a bigger write transaction
+	# Instead of querying the db once per transaction, batchsize transactions at a time are staged in a temp table and deduped
+	# against accountTrans with a single set operation. TransactionId is the primary key of accountTrans, so that is an index lookup.
+	# Only one batch is held in memory at a time, which is what keeps --stream flat on memory
+	# The write transaction is started (with the write lock) before any row is written, even to the temp table, since python's sqlite3
+	# opens a deferred transaction of its own on the first INSERT or DELETE and begin_write() would then have nothing to do. That way
+	# no other connection can add to accountTrans between the dedup and the INSERTs, but only once the first batch has been read. So
+	# other scripts can still write to the db while a file is being parsed, which with --stream happens in the loop below. See
+	# moneydb.begin_write()
+	# accountTrans cols are: TransactionId, DatePosted, Payee, Amount, Memo, Category, Notes
+	# accountMeta cols are: TransactionId, DBTimestamp, IsInGSheets
+	dbcursor = dbconn.cursor()
+	ensure_meta_index(dbconn, account)
+	dbcursor.execute('''CREATE TEMP TABLE IF NOT EXISTS StagedTrans ("TransactionId" TEXT PRIMARY KEY, "DatePosted" TEXT, "Payee" TEXT, "Amount" REAL, "Memo" TEXT)''')
+	dbTimestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+	writeCount = 0
+	skipCount = 0
+	transactions = iter(transactions)
+	while True:
+		with metrics.stage('read'): # With --stream, this is where the file is parsed
+			batch = list(itertools.islice(transactions, batchsize))
+		if not batch:
+			break
+		moneydb.begin_write(dbconn)
+		with metrics.stage('dedup'):
+			dbcursor.execute('''DELETE FROM StagedTrans''') # In case an earlier call failed half way through a batch
+			# OR IGNORE drops a transaction id that shows up more than once in the same batch. Repeats across batches are found in accountTrans below
+			dbcursor.executemany('''INSERT OR IGNORE INTO StagedTrans("TransactionId", "DatePosted", "Payee", "Amount", "Memo") VALUES (?,?,?,?,?)''', batch)
+			stagedCount = dbcursor.execute('''SELECT COUNT(*) FROM StagedTrans''').fetchone()[0]
+			# Whatever is already in accountTrans gets skipped. Only new transactions are left in StagedTrans after this
+			dbcursor.execute(moneydb.account_sql('''DELETE FROM StagedTrans WHERE "TransactionId" IN (SELECT "TransactionId" FROM {Trans})''', account))
+		batchWriteCount = stagedCount - dbcursor.rowcount
+		writeCount = writeCount + batchWriteCount
+		skipCount = skipCount + len(batch) - batchWriteCount
+		with metrics.stage('insert'):
+			# First add the transaction data. Category should be Unknown and Notes should be blank
+			dbcursor.execute(moneydb.account_sql('''INSERT INTO {Trans}("TransactionId", "DatePosted", "Payee", "Amount", "Memo", "Category", "Notes") SELECT "TransactionId", "DatePosted", "Payee", "Amount", "Memo", 'Unknown', '' FROM StagedTrans''', account))
+			# Then the transaction metadata. IsInGSheets should be 0
+			dbcursor.execute(moneydb.account_sql('''INSERT INTO {Meta}("TransactionId", "DBTimestamp", "IsInGSheets") SELECT "TransactionId", ?, 0 FROM StagedTrans''', account), (dbTimestamp,))
+			dbcursor.execute('''DELETE FROM StagedTrans''')
+	metrics.count('rowsWritten', writeCount)
+	metrics.count('rowsSkipped', skipCount)
+	if commit:
+		with metrics.stage('commit'):
+			dbconn.commit()
+	return (writeCount, skipCount)
+
+def print_ofx_data(ofxsummary):
+	# ofxsummary is what get_ofx_summary() returns
+	(accountBalance, balanceAsOf, stmtStartDate, stmtEndDate) = ofxsummary
 	print(f'Account balance: {accountBalance} as of {balanceAsOf}')
 	print(f'Statement start date: {stmtStartDate}')
 	print(f'Statement end date: {stmtEndDate}')
 
-def main():
-	(ofxfilename, sqlitedbfilename) = parseargs()
+def parse_ofx_file(ofxfilename):
+	# Runs in a worker process, so everything returned has to be picklable. Hence plain rows instead of ofxparse objects
+	# Returns (ofxfilename, account, organization, ofxsummary, rows)
 	ofx = open_ofx_file(ofxfilename)
-	dbconn = open_sqlite_db(sqlitedbfilename)
-	# TODO: Check that ofx, dbconn are not None or Null or similar
 	account = determine_account_name(ofx)
 	if account == 'Unknown':
-		print ("Unknown account/institution/organization ", ofx.account.institution.organization, "Exiting..")
-		quit() # TODO: clean up ofx and dbconn. Prolly need to close them cleanly. Try Finally?
-	print(f'Detected account: {account}')
-	print_ofx_data(ofx)
-	transactions = get_transactions(ofx)
-	print(f'Found {len(transactions)} transactions.')
-	# TODO: Ensure that transactions has at least one transaction
-	nTransactions_written = write_transactions_to_db(transactions, dbconn, account)
-	print (f'{nTransactions_written} transactions written to database')
+		return (ofxfilename, account, ofx.account.institution.organization, None, [])
+	rows = [transaction_to_row(transaction) for transaction in get_transactions(ofx)]
+	return (ofxfilename, account, ofx.account.institution.organization, get_ofx_summary(ofx), rows)
+
+def parse_ofx_files(ofxfilenames, jobs):
+	# Parsing is the expensive part, so spread the files over a pool of worker processes
+	# Results come back in the same order as ofxfilenames. A file that fails to parse is reported and left out
+	if jobs < 2 or len(ofxfilenames) < 2:
+		results = []
+		for ofxfilename in ofxfilenames:
+			try:
+				results.append(parse_ofx_file(ofxfilename))
+			except Exception as e:
+				print(f'{ofxfilename}: Could not parse file ({e}). Skipping..')
+		return results
+	results = []
+	with ProcessPoolExecutor(max_workers=min(jobs, len(ofxfilenames))) as executor:
+		futures = [executor.submit(parse_ofx_file, ofxfilename) for ofxfilename in ofxfilenames]
+		for (ofxfilename, future) in zip(ofxfilenames, futures):
+			try:
+				results.append(future.result())
+			except Exception as e:
+				print(f'{ofxfilename}: Could not parse file ({e}). Skipping..')
+	return results
+
+def write_parsed_files(results, dbconn, batchsize):
+	# results is what parse_ofx_files() returns. Each file is written and committed in one go, so the write lock is only held
+	# for as long as one file takes to write, and other scripts get their turn in between
+	# Returns a list of (account, number of files, transactions written, transactions skipped)
+	resultsByAccount = {}
+	for result in results:
+		(ofxfilename, account, organization, ofxsummary, rows) = result
+		if account == 'Unknown':
+			print (f'{ofxfilename}: Unknown account/institution/organization {organization}. Skipping..')
+			continue
+		resultsByAccount.setdefault(account, []).append(result)
+	accountTotals = []
+	for (account, accountResults) in resultsByAccount.items():
+		accountWritten = 0
+		accountSkipped = 0
+		for (ofxfilename, account, organization, ofxsummary, rows) in accountResults:
+			print(f'{ofxfilename}:')
+			print(f'Detected account: {account}')
+			print_ofx_data(ofxsummary)
+			print(f'Found {len(rows)} transactions.')
+			# TODO: Ensure that rows has at least one transaction
+			(nTransactions_written, nTransactions_skipped) = write_transactions_to_db(rows, dbconn, account, batchsize=batchsize)
+			print (f'{nTransactions_written} transactions written to database, {nTransactions_skipped} skipped as already present')
+			accountWritten = accountWritten + nTransactions_written
+			accountSkipped = accountSkipped + nTransactions_skipped
+		accountTotals.append((account, len(accountResults), accountWritten, accountSkipped))
+	return accountTotals
+
+def write_streamed_files(ofxfilenames, dbconn, batchsize):
+	# Like write_parsed_files(), but each file's transactions go straight from the file into the db, batchsize at a time. Each file
+	# is still committed in one go. The write lock is taken once its first batch has been read, see write_transactions_to_db()
+	# Only the headers are read up front, to group the files by account
+	filenamesByAccount = {}
+	for ofxfilename in ofxfilenames:
+		try:
+			with open(ofxfilename, errors='replace') as fileobj:
+				(organization, accountType, tags) = read_ofx_header(iter_ofx_tags(fileobj), {'balance': None, 'balanceAsOf': None, 'start': None, 'end': None})
+		except Exception as e:
+			print(f'{ofxfilename}: Could not read file ({e}). Skipping..')
+			continue
+		account = account_name_for(organization, accountType)
+		if account == 'Unknown':
+			print (f'{ofxfilename}: Unknown account/institution/organization {organization}. Skipping..')
+			continue
+		filenamesByAccount.setdefault(account, []).append(ofxfilename)
+	accountTotals = []
+	for (account, accountFilenames) in filenamesByAccount.items():
+		accountFiles = 0
+		accountWritten = 0
+		accountSkipped = 0
+		for ofxfilename in accountFilenames:
+			print(f'{ofxfilename}:')
+			print(f'Detected account: {account}')
+			try:
+				(organization, accountType, statementInfo, rows) = open_ofx_stream(ofxfilename)
+				(nTransactions_written, nTransactions_skipped) = write_transactions_to_db(rows, dbconn, account, batchsize=batchsize)
+			except Exception as e:
+				# The file is only read while it is written, so a bad transaction or a truncated file shows up here, part way through.
+				# Whatever of it was written already is rolled back. The files before it were committed already
+				dbconn.rollback()
+				print(f'{ofxfilename}: Could not read file ({e!r}). Skipping..')
+				continue
+			print_ofx_data((statementInfo['balance'], statementInfo['balanceAsOf'], statementInfo['start'], statementInfo['end']))
+			print(f'Found {nTransactions_written + nTransactions_skipped} transactions.')
+			print (f'{nTransactions_written} transactions written to database, {nTransactions_skipped} skipped as already present')
+			accountWritten = accountWritten + nTransactions_written
+			accountSkipped = accountSkipped + nTransactions_skipped
+			accountFiles = accountFiles + 1
+		accountTotals.append((account, accountFiles, accountWritten, accountSkipped))
+	return accountTotals
+
+def main():
+	(ofxpaths, sqlitedbfilename, jobs, stream, batchsize, metricsfilename, profilestage) = parseargs()
+	metrics.enable('ofx-to-sqlite.py', metricsfilename, profilestage)
+	ofxfilenames = expand_ofx_paths(ofxpaths)
+	metrics.count('files', len(ofxfilenames))
+	if len(ofxfilenames) < 1:
+		print('No OFX/QFX files found. Exiting..')
+		quit()
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	# TODO: Check that dbconn is not None or Null or similar
+	if stream:
+		print(f'Streaming {len(ofxfilenames)} file(s)..')
+		with metrics.stage('write'):
+			accountTotals = write_streamed_files(ofxfilenames, dbconn, batchsize)
+	else:
+		print(f'Parsing {len(ofxfilenames)} file(s)..')
+		with metrics.stage('parse'): # Wall time. With -j the files are parsed in the worker processes, which are not profiled
+			results = parse_ofx_files(ofxfilenames, jobs)
+		with metrics.stage('write'):
+			accountTotals = write_parsed_files(results, dbconn, batchsize)
+	print('Summary:')
+	for (account, nFiles, accountWritten, accountSkipped) in accountTotals:
+		print(f'{account}: {nFiles} file(s), {accountWritten} transactions written to database, {accountSkipped} skipped as already present')
 	dbconn.close()
-	# TODO: Should probably close ofx cleanly.
 
 if __name__ == "__main__":
     main()
@@ -1,26 +1,36 @@
 # This script is called as: python3 sqlite-to-gsheets.py path/to/sqlite-database.db FinancialAccountName
-# FinancialAccountName is one of valid_accounts in the verify_account() function below
+# FinancialAccountName is one of valid_accounts in moneydb.py. Or call it with --all-accounts instead of FinancialAccountName to upload every account's
+# transactions in one run, logging in to Google once
+# With --local-sheet, transactions are appended to a local csv file instead of Google Sheets, through a stand-in that has the same
+# quota as the real API. Use it to try out upload throughput and retries offline
+# With --metrics FILE, the time spent logging in, reading from the db, waiting on the rate limiter, uploading, backing off and marking
+# rows as uploaded, and the db queries, are appended to FILE (see metrics.py)
 
 # TODO: Add error checking to all of the the function calls
 # FIXME: There is likely nothing here that inserts the transactions in Google Sheets in a most-recent-transaction-first order. Need to reorder transactions in GSheets itself (Menu: Data -> Sort Sheet by Column)
-# FIXME: If there is an error uploading to gsheets, the transactions in dB will STILL be marked as uploaded. This is a BUG
 
 # REFERENCES: Read these to understand how this code connects to gsheets and the prep work you need to do in your Google account and what the client_secret.json below does
 # https://www.twilio.com/blog/2017/02/an-easy-way-to-read-and-write-to-a-google-spreadsheet-in-python.html
 # https://gspread.readthedocs.io/en/latest/oauth2.html
 
 import argparse
-import sqlite3
 import csv
 import datetime
 import dateutil.parser as dparser
 import time
+import random
+import threading
+import queue
+import re
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import moneydb
+import metrics
 
 
 def connect_to_google():
+	# Imported here so that --local-sheet works without them installed
+	import gspread
+	from oauth2client.service_account import ServiceAccountCredentials
 	# use creds to create a client to interact with the Google Drive API
 	scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
 	# Needs the existence of a file in the referred directory, named client_secret.json
@@ -31,84 +41,330 @@ def connect_to_google():
 def parseargs():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('sqlitedb', help="Name of sqlite3 database file. Expected to have extension .db")
-	parser.add_argument('account', help="Name of the account whose transactions should be sent to gsheets")
+	parser.add_argument('account', nargs='?', default=None, help="Name of the account whose transactions should be sent to gsheets")
+	parser.add_argument('-a', '--all-accounts', action='store_true', help="Send the transactions of every account instead of just one")
+	parser.add_argument('-b', '--batch-size', type=int, default=500, help="Number of transactions sent per request. Default is 500")
+	parser.add_argument('-r', '--requests-per-minute', type=float, default=defaultRequestsPerMinute, help=f"Upload requests sent per minute at most. Google allows 60 per user. Default is {defaultRequestsPerMinute}")
+	parser.add_argument('--burst', type=int, default=defaultBurst, help=f"Number of requests that may go out back to back before pacing kicks in. Default is {defaultBurst}")
+	parser.add_argument('--local-sheet', default=None, help="Append to this csv file instead of Google Sheets, for testing offline")
+	parser.add_argument('--local-quota', type=int, default=60, help="Requests per minute the --local-sheet accepts before failing with 429. Default is 60, like Google")
+	parser.add_argument('--local-latency', type=float, default=0.0, help="Seconds each --local-sheet request takes. Default is 0")
+	parser.add_argument('--local-failure-rate', type=float, default=0.0, help="Share (0 to 1) of --local-sheet requests that fail with 503. Default is 0")
+	metrics.add_arguments(parser)
 	args = parser.parse_args()
-	return (args.sqlitedb, args.account)
+	if (args.account is None) == (not args.all_accounts):
+		parser.error('Give either an account or --all-accounts')
+	accounts = moneydb.valid_accounts if args.all_accounts else [args.account]
+	return (args.sqlitedb, accounts, args.batch_size, args.requests_per_minute, args.burst, args.local_sheet, args.local_quota, args.local_latency, args.local_failure_rate, args.metrics, args.profile)
 
-def verify_account(account):
-	valid_accounts = ['AmexBlueCash', 'ChaseSapphireReserve', 'TechCUChecking', 'TechCUSavings', 'BofAChecking', 'BofASavings']
-	if account in valid_accounts:
-		return True
-	else:
+# Google Sheets API has a limit of 60 requests per minute per user (and 300 per minute per project). Transactions are therefore sent
+# batchsize rows per append_rows() request, and requests are paced by a token bucket (see RateLimiter) so a whole backlog goes
+# up in one run. A request that fails with a quota or server error is retried with exponential backoff
+# IsInGSheets is only set for the rows of a request the API confirmed, one bulk UPDATE and commit per request. If a request still
+# fails after all retries, the upload stops there and the rest of the rows stay IsInGSheets = 0 for the next run
+
+defaultRequestsPerMinute = 50 # Under Google's 60, so the user's other scripts and browser tabs still get some. See RateLimiter
+defaultBurst = 5
+retryableStatusCodes = (429, 500, 502, 503, 504) # Too many requests, and the server errors Google asks clients to retry
+
+class RateLimiter:
+	# A token bucket: holds up to burst tokens and gains requestsperminute of them a minute. Each request takes a token, waiting
+	# for one if there are none. With burst well under the quota, no 60 second window ever sees more than the quota in requests
+	def __init__(self, requestsperminute, burst):
+		self.rate = requestsperminute / 60.0
+		self.burst = burst
+		self.tokens = burst
+		self.lastRefill = time.monotonic()
+
+	def wait(self):
+		while True:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+			self.lastRefill = now
+			if self.tokens >= 1:
+				self.tokens = self.tokens - 1
+				return
+			time.sleep((1 - self.tokens) / self.rate)
+
+class LocalSheetError(Exception):
+	# What LocalSheet raises instead of gspread.exceptions.APIError. code is the HTTP status the real API would have answered with
+	def __init__(self, code, message):
+		super().__init__(f'{code}: {message}')
+		self.code = code
+
+class LocalSheet:
+	# A stand-in for the gspread worksheet that appends to a local csv file instead, for testing uploads offline
+	# It has the same quota as the real API (quotaperminute requests in any 60 seconds, failing with 429 beyond that), takes
+	# latency seconds per request, and fails a failurerate share of requests with 503, so pacing and retries can be tried out
+	def __init__(self, csvfilename, quotaperminute=60, latency=0.0, failurerate=0.0):
+		self.csvfilename = csvfilename
+		self.quotaperminute = quotaperminute
+		self.latency = latency
+		self.failurerate = failurerate
+		self.requestTimes = []
+		self.nRequests = 0
+		self.nRejected = 0
+
+	def request(self):
+		# Every request goes through this first. Raises LocalSheetError if the real API would have turned it down
+		now = time.monotonic()
+		self.requestTimes = [t for t in self.requestTimes if now - t < 60] + [now]
+		self.nRequests = self.nRequests + 1
+		time.sleep(self.latency)
+		if len(self.requestTimes) > self.quotaperminute:
+			self.nRejected = self.nRejected + 1
+			raise LocalSheetError(429, f'Quota exceeded: more than {self.quotaperminute} requests per minute')
+		if random.random() < self.failurerate:
+			self.nRejected = self.nRejected + 1
+			raise LocalSheetError(503, 'The service is currently unavailable')
+
+	def read_rows(self):
+		try:
+			with open(self.csvfilename, newline='') as csvfile:
+				return list(csv.reader(csvfile))
+		except FileNotFoundError:
+			return []
+
+	def write_rows(self, rows):
+		# Like a sheet, nothing is kept of empty cells at the end of a row, or of empty rows at the end
+		rows = [row[:max([j+1 for j in range(len(row)) if row[j] != ''], default=0)] for row in rows]
+		while rows and not rows[-1]:
+			rows.pop()
+		with open(self.csvfilename, 'w', newline='') as csvfile:
+			csv.writer(csvfile).writerows(rows)
+
+	def append_rows(self, values, value_input_option='RAW'):
+		self.request()
+		with open(self.csvfilename, 'a', newline='') as csvfile:
+			csv.writer(csvfile).writerows(values)
+		# The parts of the API's append response that append_rows_with_retries() looks at
+		return {'updates': {'updatedRows': len(values)}}
+
+	def update(self, range_name='A1', values=None, value_input_option='RAW'):
+		# Like gspread's Worksheet.update(), writes values with their top left cell at range_name, e.g. 'A1'
+		self.request()
+		(firstRow, firstColumn, lastRow, lastColumn) = parse_a1_range(range_name)
+		rows = self.read_rows()
+		for (i, value) in enumerate(values):
+			while len(rows) <= firstRow + i:
+				rows.append([])
+			row = rows[firstRow + i]
+			row.extend([''] * (firstColumn + len(value) - len(row)))
+			row[firstColumn:firstColumn+len(value)] = [str(cell) for cell in value]
+		self.write_rows(rows)
+		return {'updatedRows': len(values)}
+
+	def batch_clear(self, ranges):
+		# Like gspread's Worksheet.batch_clear(), empties the cells of each of ranges, e.g. 'A10:Z' for everything from row 10 down
+		self.request()
+		rows = self.read_rows()
+		for range_name in ranges:
+			(firstRow, firstColumn, lastRow, lastColumn) = parse_a1_range(range_name)
+			for row in rows[firstRow:None if lastRow is None else lastRow+1]:
+				for j in range(firstColumn, len(row) if lastColumn is None else min(lastColumn+1, len(row))):
+					row[j] = ''
+		self.write_rows(rows)
+		return {'clearedRanges': list(ranges)}
+
+a1RangePattern = re.compile(r'([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$')
+
+def parse_a1_range(range_name):
+	# 'B2:D' -> (1, 1, None, 3): first and last row and column, counting from 0. None where the range has no end. For LocalSheet
+	def column_index(letters):
+		index = 0
+		for letter in letters:
+			index = index * 26 + ord(letter) - ord('A') + 1
+		return index - 1
+	(firstColumn, firstRow, lastColumn, lastRow) = a1RangePattern.match(range_name).groups()
+	firstRow = int(firstRow) - 1 if firstRow else 0
+	if lastColumn is None:
+		return (firstRow, column_index(firstColumn), None, None)
+	return (firstRow, column_index(firstColumn), int(lastRow) - 1 if lastRow else None, column_index(lastColumn))
+
+def error_status_code(e):
+	# The HTTP status of a failed request, or None if e is not an API error. LocalSheetError and gspread 6's APIError have it as
+	# code. gspread 5's APIError only has the requests response it came from
+	code = getattr(e, 'code', None)
+	if code is None and getattr(e, 'response', None) is not None:
+		code = getattr(e.response, 'status_code', None)
+	return code
+
+def send_with_retries(request, what, ratelimiter, retries=6):
+	# Makes one API request by calling request(), and returns its response. Returns None if it still failed after retries retries
+	# Only quota and server errors are retried, with a backoff of 1, 2, 4.. seconds plus some jitter. what is for the error messages
+	for attempt in range(retries+1):
+		with metrics.stage('rate-limit'):
+			ratelimiter.wait()
+		metrics.count('requests')
+		try:
+			with metrics.stage('upload'):
+				return request()
+		except Exception as e:
+			code = error_status_code(e)
+			if code not in retryableStatusCodes or attempt == retries:
+				print(f'Could not upload {what}: {e}')
+				return None
+			backoff = min(2 ** attempt, 64) + random.random()
+			print(f'Upload failed with {code}. Retrying in {backoff:.1f}s..')
+			metrics.count('retries')
+			with metrics.stage('backoff'):
+				time.sleep(backoff)
+
+def append_rows_with_retries(sheet, rows, ratelimiter, retries=6):
+	# Sends rows in a single append request, see send_with_retries(). Returns True if the API confirmed all of them were appended
+	response = send_with_retries(lambda: sheet.append_rows(rows, value_input_option='USER_ENTERED'), f'{len(rows)} transactions', ratelimiter, retries)
+	if response is None:
+		return False
+	updatedRows = response.get('updates', {}).get('updatedRows', 0)
+	if updatedRows != len(rows):
+		print(f'Sent {len(rows)} transactions but Google Sheets confirmed {updatedRows}. Not marking them as uploaded.')
+		return False
+	return True
+
+def iter_pending_rows(dbconn, account, batchsize, skipunknown=False):
+	# Generator of lists of at most batchsize TransactionId,DatePosted,Payee,Amount,Memo,Category,Notes rows with IsInGSheets = 0
+	# With skipunknown, rows that are still Unknown are left out, to be uploaded once they have been categorized
+	# Pages through them by TransactionId instead of keeping one cursor open, since each batch is marked as uploaded before the next one is read
+	# {Trans} and {Meta} are account's tables, see moneydb.account_sql() and the db structure for details
+	lastTransactionId = ''
+	categoryFilter = ''' AND {Trans}.Category != 'Unknown' ''' if skipunknown else ' '
+	while True:
+		with metrics.stage('read'):
+			dbcursor = dbconn.cursor()
+			dbcursor.execute(moneydb.account_sql('''SELECT {Trans}.TransactionId, DatePosted, Payee, Amount, Memo, Category, Notes FROM {Trans} INNER JOIN {Meta} ON {Meta}.TransactionId = {Trans}.TransactionId WHERE {Meta}.IsInGSheets = 0'''+categoryFilter+'''AND {Trans}.TransactionId > ? ORDER BY {Trans}.TransactionId LIMIT ?''', account), (lastTransactionId, batchsize))
+			rows = dbcursor.fetchall()
+		if len(rows) < 1:
+			return
+		yield rows
+		lastTransactionId = rows[-1][0]
+
+isoDatePattern = re.compile(r'\d{4}-\d{2}-\d{2}$') # A DatePosted like 2024-01-31
+
+def make_gsheets_rows(account, dbrows):
+	# dbrow[i] is from Transaction id[0], Date posted[1], Payee[2], Amount[3], Memo[4], Category[5], Notes[6] which needs to be mapped to ofieldnames above which are the cols of the GSheet
+	# GSheets headers are: DatePosted, Payee, Category, Amount, Note, Account, Memo, TransactionID, TransactionHash, TransactionMonth, GSheetTimestamp
+	# GSheetTimestamp is left empty here. It is filled in by upload_batch() when the rows are actually sent
+	GSheetsRows = []
+	for dbrow in dbrows:
+		# DatePosted is YYYY-MM-DD (ofx-to-sqlite.py writes it that way), so the month is just its first 8 characters. Only anything
+		# else, e.g. dates typed in by hand, goes through the much slower dparser
+		month = dbrow[1][:8]+'01' if isoDatePattern.match(dbrow[1]) else dparser.parse(dbrow[1]).replace(day=1).strftime('%Y-%m-%d')
+		GSheetsRows.append([dbrow[1], dbrow[2], dbrow[5], dbrow[3], dbrow[6], account, dbrow[4], dbrow[0], '', month, ''])
+	return GSheetsRows
+
+def put_unless_stopping(batches, item, stopping):
+	# Puts item on the batches queue, waiting for room, unless stopping gets set first. Returns False if it did
+	# Never blocks for good on a full queue, since update_gsheets() stops taking from it as soon as an upload fails
+	while not stopping.is_set():
+		try:
+			batches.put(item, timeout=0.1)
+			return True
+		except queue.Full:
+			pass
+	return False
+
+def read_pending_batches(sqlitedbfilename, accounts, batchsize, batches, stopping, skipunknown=False):
+	# The producer half of update_gsheets(): reads the rows with IsInGSheets = 0 of each account in turn, batchsize at a time, and
+	# puts (account, dbrows, GSheetsRows) on the batches queue, then None once there are no more. Stops early if stopping gets set
+	# Runs on its own thread, so it opens its own connection to the db. Any error is put on the queue for update_gsheets() to raise
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	try:
+		for account in accounts:
+			for dbrows in iter_pending_rows(dbconn, account, batchsize, skipunknown):
+				with metrics.stage('format'):
+					batch = (account, dbrows, make_gsheets_rows(account, dbrows))
+				if not put_unless_stopping(batches, batch, stopping):
+					return
+		put_unless_stopping(batches, None, stopping)
+	except Exception as e:
+		put_unless_stopping(batches, e, stopping)
+	finally:
+		dbconn.close()
+
+def upload_batch(dbconn, sheet, account, dbrows, GSheetsRows, ratelimiter):
+	# Uploads one batch of account's rows and, if the API confirmed it, marks them IsInGSheets = 1 in one UPDATE and commit
+	# Returns True if the batch was uploaded
+	# Create a timestamp for when these rows are sent to GSheets
+	gsheetts = datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S.%f')
+	for GSheetsRow in GSheetsRows:
+		GSheetsRow[10] = gsheetts
+	if not append_rows_with_retries(sheet, GSheetsRows, ratelimiter):
 		return False
+	# The , at the end of (dbrow[0],) makes it a tuple of size 1. Without it, it'd be as if we have supplied strlen(transid) number of bindings
+	# See: https://stackoverflow.com/questions/16856647/sqlite3-programmingerror-incorrect-number-of-bindings-supplied-the-current-sta
+	with metrics.stage('mark'), moneydb.write_transaction(dbconn):
+		dbconn.executemany(moneydb.account_sql('''UPDATE {Meta} SET IsInGsheets = 1 WHERE TransactionId = ?''', account), [(dbrow[0],) for dbrow in dbrows])
+	metrics.count('rowsUploaded', len(dbrows))
+	return True
 
-# TODO: Add error checking to this function
-def open_sqlite_db(sqlitedbfilename):
-	# TODO: Verify sqlitedbfilename exists?
-	dbconn = sqlite3.connect(sqlitedbfilename)
-	# TODO: Verify connect is successful?
-	return dbconn
-
-# CAUTION CAUTION CAUTION
-# If the sheet.append_row() function fails for any reason, this entire function gets b0rked and leaves database IsInGSheets in ill-defined state
-# ---> There seems to be no way to know if a row was indeed successfully uploaded to GSheets <--- ?? Maybe catch gspread.exceptions.APIError?
-# Google Sheets API has a limit of 500 requests per 100 seconds per project, and 100 requests per 100 seconds per user.
-# If these limits are exceeded, the append_row() function throws an exception and this prog. halts, leaving some transactions uploaded to GSheets, but for which IsInGSheets remains 0
-# Maybe best to wait 100s if numTransactionsUploaded = 99 ??
-# Or find some way of batching multiple rows into a single call??
-def update_gsheets(dbconn, account, sheet):
-	# Find all transactions in db/account for which IsInGSheets = 0
-	# Upload that transaction to GSheet
-	# Update record for transaction IsInGSheet = 1
-	institution = account+'Trans' # See db structure for details
-	institutionMeta = account+'Meta' # See db structure for details
-	dbcursor = dbconn.cursor()	
-	dbcursor.execute('''SELECT COUNT(*) FROM '''+institution+''' INNER JOIN '''+institutionMeta+''' ON '''+institutionMeta+'''.TransactionId = '''+institution+'''.TransactionId WHERE '''+institutionMeta+'''.IsInGSheets = 0''')
-	numRows = dbcursor.fetchone() # This is actually a tuple, I think, with numRows[0] being the actual number of rows
-	print (f"Found {numRows[0]} transactions which have not been uploaded to Google Sheets.")
-	if numRows[0] < 1:
-		print(f'There are no un-uploaded transactions. Quitting.')
-		quit()
-	dbcursor.execute('''SELECT * FROM '''+institution+''' INNER JOIN '''+institutionMeta+''' ON '''+institutionMeta+'''.TransactionId = '''+institution+'''.TransactionId WHERE '''+institutionMeta+'''.IsInGSheets = 0''')
+def update_gsheets(dbconn, accounts, sheet, batchsize=500, ratelimiter=None, skipunknown=False):
+	# Find all transactions in db/account for which IsInGSheets = 0, for each account in accounts. With skipunknown, leave out the Unknown ones
+	# Upload them to GSheet, batchsize at a time
+	# Update records for transactions IsInGSheet = 1, for each batch that was confirmed uploaded
+	# Reading and formatting the next batches (read_pending_batches(), on a thread of its own) overlaps with uploading the current one
+	# Returns a dict of account -> number of transactions uploaded
+	if ratelimiter is None:
+		ratelimiter = RateLimiter(defaultRequestsPerMinute, defaultBurst)
+	sqlitedbfilename = dbconn.execute('PRAGMA database_list').fetchone()[2] # The file dbconn has open, for read_pending_batches()' own connection
+	batches = queue.Queue(maxsize=4) # Enough read-ahead to always have the next batch ready, without reading everything into memory
+	stopping = threading.Event()
+	producer = threading.Thread(target=read_pending_batches, args=(sqlitedbfilename, accounts, batchsize, batches, stopping, skipunknown), daemon=True)
+	producer.start()
 	
-	idsToBeUpdated = []
-
-	for count, dbrow in enumerate(dbcursor):
-		# dbrow[i] is from Transaction id[0], Date posted[1], Payee[2], Amount[3], Memo[4], Category[5], Notes[6] which needs to be mapped to ofieldnames above which are the cols of the GSheet
-		# 
-		month = dparser.parse(dbrow[1]).replace(day=1).strftime('%Y-%m-%d')
-		# Create a timestamp for when this row is sent to GSheets
-		gsheetts = datetime.datetime.now().strftime('%m/%d/%Y %H:%M:%S.%f')
-		# GSheets headers are: DatePosted, Payee, Category, Amount, Note, Account, Memo, TransactionID, TransactionHash, TransactionMonth, GSheetTimestamp
-		GSheetsRow = [dbrow[1], dbrow[2], dbrow[5], dbrow[3], dbrow[6], account, dbrow[4], dbrow[0], '', month, gsheetts]		
-		sheet.append_row(GSheetsRow, value_input_option='USER_ENTERED')
-		idsToBeUpdated.append(dbrow[0]) # populate transaction ids that need to be marked withIsInGSheets = 1
-		if count > 95: # Don't hit GSheets API limit of 100 writes per 100 secs
-			print(f'Have uploaded {count+1} transactions. Stopping now to avoid hitting GSheets API limits. Please try again after 100 seconds for remaining transactions.')
-			break
+	nUploaded = {account: 0 for account in accounts}
+	stoppedEarly = False
+	startTime = time.perf_counter()
+	try:
+		while True:
+			with metrics.stage('wait-for-read'): # Uploads waiting on read_pending_batches(). Should be close to 0
+				batch = batches.get()
+			if batch is None:
+				break
+			if isinstance(batch, Exception):
+				raise batch
+			(account, dbrows, GSheetsRows) = batch
+			if not upload_batch(dbconn, sheet, account, dbrows, GSheetsRows, ratelimiter):
+				print(f'Stopping. The remaining transactions were not marked as uploaded, so the next run will pick them up.')
+				stoppedEarly = True
+				break
+			nUploaded[account] = nUploaded[account] + len(dbrows)
+			print(f'Uploaded {len(dbrows)} {account} transactions.')
+	finally:
+		stopping.set()
+		producer.join()
 		
-	for transid in idsToBeUpdated:	
-		# That , at the end of (transid,) is important. See: https://stackoverflow.com/questions/16856647/sqlite3-programmingerror-incorrect-number-of-bindings-supplied-the-current-sta
-		# The , means that transid is a sequence (tuple in this case) of size 1. Without the , it'll be as if we have supplied strlen(transid) number of bindings
-		dbcursor.execute('''UPDATE '''+institutionMeta+''' SET IsInGsheets = 1 WHERE TransactionId = ?''', (transid,))
-		
-	print (f"Processed {len(idsToBeUpdated)} transactions.")
-	
-	dbconn.commit()
+	elapsed = time.perf_counter() - startTime
+	total = sum(nUploaded.values())
+	if total < 1 and not stoppedEarly:
+		print(f'There are no un-uploaded transactions.')
+		return nUploaded
+	for account in accounts:
+		print(f'{account}: {nUploaded[account]} transactions uploaded')
+	print (f"Uploaded {total} transactions in {elapsed:.1f}s ({total/max(elapsed, 1e-9):.0f} transactions/s).")
+	return nUploaded
 	
 def main():
-	# TODO: Error checking for below func
-	client = connect_to_google()
-	sheet = client.open("Finances").worksheet("Transactions")
+	(sqlitedbfilename, accounts, batchsize, requestsperminute, burst, localsheetfilename, localquota, locallatency, localfailurerate, metricsfilename, profilestage) = parseargs()
+	metrics.enable('sqlite-to-gsheets.py', metricsfilename, profilestage)
+	for account in accounts:
+		if moneydb.verify_account(account) == False:
+			print(f'Unknown account: {account}. Stopping..')
+			quit()
 	
-	(sqlitedbfilename, account) = parseargs()
-	if verify_account(account) == False:
-		print(f'Unknown account: {account}. Stopping..')
-		quit()
+	# Logging in and opening the worksheet happens once, however many accounts there are
+	if localsheetfilename:
+		sheet = LocalSheet(localsheetfilename, localquota, locallatency, localfailurerate)
+	else:
+		# TODO: Error checking for below func
+		with metrics.stage('connect'):
+			client = connect_to_google()
+			sheet = client.open("Finances").worksheet("Transactions")
 		
-	dbconn = open_sqlite_db(sqlitedbfilename)
-	update_gsheets(dbconn, account, sheet)
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	update_gsheets(dbconn, accounts, sheet, batchsize, RateLimiter(requestsperminute, burst))
 	dbconn.close()
+	if localsheetfilename:
+		print(f'{sheet.nRequests} requests made to the local sheet, {sheet.nRejected} of them rejected.')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,259 @@
+# This script is called as: python3 watch-inbox.py path/to/inbox path/to/sqlite-database.db
+# It keeps running, and does what ofx-to-sqlite.py, autocategorize.py --batch and sqlite-to-gsheets.py --all-accounts do, for every
+# OFX/QFX file that shows up in path/to/inbox: the file is written to the db, its new transactions are categorized, and the ones that
+# got a category are uploaded to Google Sheets. Then the file is moved to path/to/inbox/processed/ (or path/to/inbox/failed/ if it
+# could not be read or written, or is for an unknown account). A file that could not be written because the db was locked by
+# another script for too long is left in the inbox and tried again. Errors are printed, and the daemon keeps watching
+# Unlike running the three scripts one after the other, nothing is started cold for each statement: pandas and scikit-learn are
+# imported once, the classifier of every account is trained (or loaded from the cache) once, in the background as soon as the
+# daemon starts, and it logs in to Google once. So a statement is categorized as soon as it is written, in well under a second
+# Only guesses that are at least --threshold sure (and merchant lookup index hits, which always are) are written. The rest stay
+# Unknown and are not uploaded. Review them later with autocategorize.py, like any other uncategorized transactions
+# After every statement, the merchant lookup index (see autocategorize.py) is reloaded, so categories given in a review session count
+# straight away. Once --retrain-after more transactions have been categorized outside of the daemon, the account's classifier is
+# retrained in the background, and the old one is used until the new one is ready
+# Uploads are batched: categorized transactions are uploaded every --export-interval seconds, or as soon as there are --batch-size of them
+
+import argparse
+import os
+import time
+import datetime
+import signal
+import sqlite3
+import concurrent.futures
+
+import moneydb
+import metrics
+
+ofxtosqlite = moneydb.load_script('ofx-to-sqlite.py')
+autocategorize = moneydb.load_script('autocategorize.py')
+sqlitetogsheets = moneydb.load_script('sqlite-to-gsheets.py')
+
+class WarmModels:
+	# The classifier, merchant lookup index and fallback category of each account, kept in memory between statements
+	# Classifiers are trained with autocategorize.train_classifier() on a background thread, so they go through the model cache too
+	def __init__(self, sqlitedbfilename, modelcachedir, modelcachekeep, backend, retrainafter):
+		self.sqlitedbfilename = sqlitedbfilename
+		self.modelcachedir = modelcachedir
+		self.modelcachekeep = modelcachekeep
+		self.backend = backend
+		self.retrainafter = retrainafter
+		self.trainer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.models = {} # account -> (classifier, tfidf, le)
+		self.training = {} # account -> (Future of (classifier, tfidf, le), number of categorized transactions it is trained on)
+		self.trainedOn = {} # account -> number of categorized transactions its classifier in models is trained on
+		self.applied = {} # account -> number of transactions the daemon categorized itself since then
+		self.lookups = {}
+		self.fallbacks = {}
+
+	def refresh(self, dbconn, account):
+		# Reloads account's lookup index and fallback category, and starts training its classifier if it has none yet, or if
+		# retrainafter transactions were categorized outside of the daemon since it was trained. Does not wait for the training
+		autocategorize.ensure_lookup_index(dbconn, account)
+		self.lookups[account] = autocategorize.load_lookup_index(dbconn, account)
+		self.fallbacks[account] = autocategorize.get_fallback_category(dbconn, account)
+		nCategorized = dbconn.execute(moneydb.account_sql('''SELECT COUNT(*) FROM {Trans} WHERE Category != 'Unknown' ''', account)).fetchone()[0]
+		if nCategorized < 1 or account in self.training: # train_classifier() stops the script if there is nothing to train on
+			return
+		if account not in self.trainedOn or nCategorized - self.applied[account] - self.trainedOn[account] >= self.retrainafter:
+			self.training[account] = (self.trainer.submit(autocategorize.train_classifier, self.sqlitedbfilename, account, None, self.modelcachedir, False, self.modelcachekeep, self.backend), nCategorized)
+
+	def get(self, account, wait=False):
+		# Returns account's classifier, or None if it has none yet. A retrained one replaces the old one as soon as it is ready
+		# With wait, waits for the first classifier of account if it is still being trained
+		if account in self.training:
+			(future, nCategorized) = self.training[account]
+			if future.done() or (wait and account not in self.models):
+				del self.training[account]
+				(self.trainedOn[account], self.applied[account]) = (nCategorized, 0) # Even if it failed, so it is not retried right away
+				model = autocategorize.wait_for_classifier(future) # None if the training failed. Then the one it had, if any, stays
+				if model is not None:
+					self.models[account] = model
+		return self.models.get(account)
+
+	def add_applied(self, account, n):
+		self.applied[account] = self.applied.get(account, 0) + n
+
+	def shutdown(self):
+		self.trainer.shutdown(wait=False, cancel_futures=True)
+
+def iter_transactions_by_id(dbconn, account, transactionids, chunksize=500):
+	# Generator of lists of the TransactionId,Payee,Memo,Amount rows of those of transactionids that are still Unknown, at most
+	# chunksize ids at a time (so the query stays well below SQLite's limit on the number of ? in one statement)
+	for start in range(0, len(transactionids), chunksize):
+		chunk = transactionids[start:start+chunksize]
+		dbcursor = dbconn.cursor()
+		dbcursor.execute(moneydb.account_sql('''SELECT TransactionId,Payee, Memo, Amount FROM {Trans} WHERE Category = 'Unknown' AND TransactionId IN ('''+','.join('?' * len(chunk))+''')''', account), chunk)
+		uncategorized_records = dbcursor.fetchall()
+		if len(uncategorized_records) > 0:
+			yield uncategorized_records
+
+def existing_transaction_ids(dbconn, account, transactionids, chunksize=500):
+	# The set of those of transactionids that are in the db already
+	existing = set()
+	for start in range(0, len(transactionids), chunksize):
+		chunk = transactionids[start:start+chunksize]
+		dbcursor = dbconn.cursor()
+		dbcursor.execute(moneydb.account_sql('''SELECT TransactionId FROM {Trans} WHERE TransactionId IN ('''+','.join('?' * len(chunk))+''')''', account), chunk)
+		existing.update(row[0] for row in dbcursor.fetchall())
+	return existing
+
+def categorize_account(dbconn, models, account, threshold, transactionids):
+	# Guesses the transactions of account with the given ids (the ones a statement just added) from the lookup index and the
+	# classifier, and writes the guesses that are at least threshold sure. Returns (number written, number left Unknown)
+	# Older Unknown transactions of the account are left alone. They are waiting for a review already, and guessing them again for
+	# every statement would only make each statement take longer the more of them there are
+	models.refresh(dbconn, account)
+	model = models.get(account, wait=True)
+	nApplied = 0
+	nHeld = 0
+	for uncategorized_transactions in iter_transactions_by_id(dbconn, account, transactionids): # Each row is TransactionId,Payee,Memo,Amount
+		(guessed_categories, confidences, nHits) = autocategorize.guess_categories(model, models.lookups[account], uncategorized_transactions, models.fallbacks[account])
+		accepted = [i for i in range(len(confidences)) if confidences[i] >= threshold and guessed_categories[i] != 'Unknown']
+		autocategorize.write_verified_categories_to_db(dbconn, account, [uncategorized_transactions[i] for i in accepted], [guessed_categories[i] for i in accepted], [''] * len(accepted))
+		nApplied = nApplied + len(accepted)
+		nHeld = nHeld + len(uncategorized_transactions) - len(accepted)
+	models.add_applied(account, nApplied)
+	return (nApplied, nHeld)
+
+def find_new_statements(inbox, settle):
+	# The OFX/QFX files in inbox (not in its subdirectories) that have not changed for settle seconds. Files that are still being
+	# downloaded or copied in are left for a later poll
+	now = time.time()
+	return [ofxfilename for ofxfilename in ofxtosqlite.expand_ofx_paths([inbox]) if now - os.path.getmtime(ofxfilename) >= settle]
+
+def move_to(ofxfilename, directory):
+	# Moves ofxfilename into directory. If a file of the same name is there already (the same statement downloaded twice), the
+	# time is added to the name
+	os.makedirs(directory, exist_ok=True)
+	(name, extension) = os.path.splitext(os.path.basename(ofxfilename))
+	target = os.path.join(directory, name+extension)
+	if os.path.exists(target):
+		target = os.path.join(directory, name+datetime.datetime.now().strftime('-%Y%m%d%H%M%S')+extension)
+	os.replace(ofxfilename, target)
+
+def process_statement(dbconn, models, ofxfilename, threshold, inbox):
+	# Writes ofxfilename to the db, categorizes its account and moves the file out of the inbox. Returns the number of transactions categorized
+	startTime = time.perf_counter()
+	try:
+		(ofxfilename, account, organization, ofxsummary, rows) = ofxtosqlite.parse_ofx_file(ofxfilename)
+	except Exception as e:
+		print(f'{ofxfilename}: Could not parse file ({e}). Moving it to failed/.')
+		move_to(ofxfilename, os.path.join(inbox, 'failed'))
+		return 0
+	if account == 'Unknown':
+		print(f'{ofxfilename}: Unknown account/institution/organization {organization}. Moving it to failed/.')
+		move_to(ofxfilename, os.path.join(inbox, 'failed'))
+		return 0
+	try:
+		# Which of the statement's transactions are new, so that only those are categorized below
+		statementIds = list(dict.fromkeys(row[0] for row in rows))
+		existingIds = existing_transaction_ids(dbconn, account, statementIds)
+		(nWritten, nSkipped) = ofxtosqlite.write_transactions_to_db(rows, dbconn, account)
+	except Exception as e:
+		dbconn.rollback()
+		if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+			# Another script held the write lock for longer than moneydb.busyTimeout. Nothing was written, so try again next poll
+			print(f'{ofxfilename}: Could not write to the db ({e}). Leaving it in the inbox to try again.')
+		else:
+			print(f'{ofxfilename}: Could not write to the db ({e}). Moving it to failed/.')
+			move_to(ofxfilename, os.path.join(inbox, 'failed'))
+		return 0
+	try:
+		newIds = [transactionid for transactionid in statementIds if transactionid not in existingIds]
+		(nApplied, nHeld) = categorize_account(dbconn, models, account, threshold, newIds) if nWritten > 0 else (0, 0)
+	except Exception as e:
+		# The transactions are in the db already. They stay Unknown until the account's next statement, or autocategorize.py
+		dbconn.rollback()
+		print(f'{ofxfilename}: {nWritten} new transactions written, but could not categorize them ({e}). They were left Unknown.')
+		(nApplied, nHeld) = (0, nWritten)
+	move_to(ofxfilename, os.path.join(inbox, 'processed'))
+	print(f'{ofxfilename}: {account}, {nWritten} new transactions ({nSkipped} already in db). {nApplied} categorized, {nHeld} left Unknown for review. Took {time.perf_counter()-startTime:.2f}s.')
+	return nApplied
+
+def watch(dbconn, models, inbox, threshold, sheet, ratelimiter, batchsize, interval, exportinterval, settle, once):
+	# Polls inbox every interval seconds until interrupted (or, with once, just once). See the top of this file
+	nPendingExport = 0
+	lastExport = time.monotonic()
+	try:
+		while True:
+			for ofxfilename in find_new_statements(inbox, 0 if once else settle):
+				with metrics.stage('statement'):
+					nPendingExport = nPendingExport + process_statement(dbconn, models, ofxfilename, threshold, inbox)
+				metrics.count('statements')
+			if sheet is not None and nPendingExport > 0 and (once or nPendingExport >= batchsize or time.monotonic() - lastExport >= exportinterval):
+				try:
+					with metrics.stage('export'):
+						nUploaded = sqlitetogsheets.update_gsheets(dbconn, moneydb.valid_accounts, sheet, batchsize, ratelimiter, skipunknown=True)
+					# Whatever did not go up (the upload stopped early) is tried again with the next export
+					nPendingExport = max(0, nPendingExport - sum(nUploaded.values()))
+				except Exception as e:
+					dbconn.rollback()
+					print(f'Could not upload ({e}). Trying again with the next export.')
+				lastExport = time.monotonic()
+			if once:
+				return
+			time.sleep(interval)
+	except KeyboardInterrupt:
+		print('Stopping..')
+		if sheet is not None and nPendingExport > 0:
+			print(f'{nPendingExport} categorized transactions were not uploaded yet. Run sqlite-to-gsheets.py --all-accounts, or start watch-inbox.py again, to upload them.')
+
+def parseargs():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('inbox', help="Directory to watch for new OFX/QFX files")
+	parser.add_argument('sqlitedbfile', help="SQLite database. Expected to have extention .db")
+	parser.add_argument('-i', '--interval', type=float, default=5, help="Seconds between looks at the inbox. Default is 5")
+	parser.add_argument('--settle', type=float, default=2, help="Seconds a file has to be left unchanged before it is picked up, so half-copied files are not. Default is 2")
+	parser.add_argument('--once', action='store_true', help="Process the files in the inbox now, upload, and exit, instead of watching")
+	parser.add_argument('--threshold', type=float, default=0.9, help="Confidence (0 to 1) a guess needs to be written. Less confident ones are left Unknown for review. Default is 0.9")
+	parser.add_argument('-c', '--classifier', choices=sorted(autocategorize.classifier_backends), default='forest', help="Classifier backend, see autocategorize.py. Default is forest")
+	parser.add_argument('-m', '--model-cache', default=None, help="Directory where trained classifiers are cached. Default is model-cache/ next to the sqlite db. Pass 'none' to turn the cache off")
+	parser.add_argument('--model-cache-keep', type=int, default=2, help="Number of cached classifiers kept per account. Default is 2")
+	parser.add_argument('--retrain-after', type=int, default=100, help="Retrain an account's classifier once this many of its transactions were categorized outside of the daemon (e.g. in a review session). Default is 100")
+	parser.add_argument('-n', '--no-upload', action='store_true', help="Do not upload anything to Google Sheets")
+	parser.add_argument('-e', '--export-interval', type=float, default=60, help="Seconds between uploads of categorized transactions. Default is 60")
+	parser.add_argument('-b', '--batch-size', type=int, default=500, help="Number of transactions sent per request, and number of categorized transactions that triggers an upload right away. Default is 500")
+	parser.add_argument('-r', '--requests-per-minute', type=float, default=sqlitetogsheets.defaultRequestsPerMinute, help=f"Upload requests sent per minute at most. Default is {sqlitetogsheets.defaultRequestsPerMinute}")
+	parser.add_argument('--local-sheet', default=None, help="Append to this csv file instead of Google Sheets, for testing offline")
+	metrics.add_arguments(parser)
+	args = parser.parse_args()
+	if args.model_cache_keep < 1:
+		parser.error('--model-cache-keep has to be at least 1, the classifier that was just cached')
+	if not 0 <= args.threshold <= 1:
+		parser.error('--threshold has to be between 0 and 1, e.g. 0.8 for 80% sure')
+	modelcachedir = args.model_cache
+	if modelcachedir is None:
+		modelcachedir = os.path.join(os.path.dirname(os.path.abspath(args.sqlitedbfile)), 'model-cache')
+	elif modelcachedir.lower() == 'none':
+		modelcachedir = None
+	return (args.inbox, args.sqlitedbfile, args.interval, args.settle, args.once, args.threshold, args.classifier, modelcachedir, args.model_cache_keep, args.retrain_after, args.no_upload, args.export_interval, args.batch_size, args.requests_per_minute, args.local_sheet, args.metrics, args.profile)
+
+def main():
+	(inbox, sqlitedbfilename, interval, settle, once, threshold, backend, modelcachedir, modelcachekeep, retrainafter, noupload, exportinterval, batchsize, requestsperminute, localsheetfilename, metricsfilename, profilestage) = parseargs()
+	metrics.enable('watch-inbox.py', metricsfilename, profilestage)
+	if not os.path.isdir(inbox):
+		print(f'{inbox} is not a directory. Stopping..')
+		quit()
+	if noupload:
+		sheet = None
+	elif localsheetfilename:
+		sheet = sqlitetogsheets.LocalSheet(localsheetfilename)
+	else:
+		# Logged in once, for as long as the daemon runs
+		client = sqlitetogsheets.connect_to_google()
+		sheet = client.open("Finances").worksheet("Transactions")
+	dbconn = moneydb.open_sqlite_db(sqlitedbfilename)
+	models = WarmModels(sqlitedbfilename, modelcachedir, modelcachekeep, backend, retrainafter)
+	# Start training every account's classifier right away, so they are warm by the time the first statement comes in
+	for account in moneydb.valid_accounts:
+		models.refresh(dbconn, account)
+	if not once:
+		print(f'Watching {inbox} for OFX/QFX files every {interval:g}s. Press Ctrl-C to stop.')
+		signal.signal(signal.SIGTERM, signal.default_int_handler) # Stop the same way on kill (e.g. from a service manager) as on Ctrl-C
+	watch(dbconn, models, inbox, threshold, sheet, sqlitetogsheets.RateLimiter(requestsperminute, sqlitetogsheets.defaultBurst), batchsize, interval, exportinterval, settle, once)
+	models.shutdown()
+	dbconn.close()
+
+if __name__ == "__main__":
+    main()